@@ -8,16 +8,24 @@ De frontend stuurt POST requests naar deze API.
 CORS is ingeschakeld zodat GitHub Pages de API kan bereiken.
 
 Vereisten:
-    pip install flask flask-cors pyodbc
+    pip install flask flask-cors pyodbc orjson
 """
 
+import atexit
 import datetime
+import decimal
 import json
 import os
+import queue
+import signal
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
+import orjson
 import pyodbc
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 
 app = Flask(__name__)
@@ -30,6 +38,19 @@ DB_SERVER = os.environ.get('DB_SERVER', 'localhost')
 DB_NAME = os.environ.get('DB_NAME', 'CBS_Buurtdata')
 DB_DRIVER = '{ODBC Driver 17 for SQL Server}'
 
+# Connection pool: verbindingen worden hergebruikt i.p.v. per request een
+# nieuwe login-handshake met SQL Server te doen.
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))  # ~ 2x aantal worker threads
+POOL_TIMEOUT = 10     # seconden wachten op een vrije verbinding
+POOL_PING_AFTER = 60  # seconden idle voordat een verbinding eerst getest wordt
+
+pyodbc.pooling = True  # ODBC driver-manager pooling (moet voor de eerste connect)
+
+_pool = queue.Queue(maxsize=POOL_SIZE)  # (conn, laatst_gebruikt) tuples
+_pool_lock = threading.Lock()
+_pool_created = 0
+
+
 def get_conn():
     """Maak verbinding met SQL Server (Windows Authentication)."""
     return pyodbc.connect(
@@ -37,41 +58,247 @@ def get_conn():
         autocommit=True
     )
 
+
+def _discard(conn):
+    """Sluit een kapotte verbinding en geef de plek in de pool vrij."""
+    global _pool_created
+    try:
+        conn.close()
+    except pyodbc.Error:
+        pass
+    with _pool_lock:
+        _pool_created -= 1
+
+
+def _checkout():
+    """Haal een verbinding uit de pool (of maak er een zolang er ruimte is)."""
+    global _pool_created
+    while True:
+        try:
+            conn, last_used = _pool.get_nowait()
+        except queue.Empty:
+            with _pool_lock:
+                can_create = _pool_created < POOL_SIZE
+                if can_create:
+                    _pool_created += 1
+            if can_create:
+                try:
+                    return get_conn()
+                except Exception:
+                    with _pool_lock:
+                        _pool_created -= 1
+                    raise
+            try:
+                conn, last_used = _pool.get(timeout=POOL_TIMEOUT)
+            except queue.Empty:
+                raise RuntimeError(f'Geen vrije databaseverbinding na {POOL_TIMEOUT}s (pool vol)')
+
+        # Lang idle verbindingen eerst testen (server kan ze gesloten hebben)
+        if time.monotonic() - last_used > POOL_PING_AFTER:
+            try:
+                conn.cursor().execute("SELECT 1").fetchone()
+            except pyodbc.Error:
+                _discard(conn)
+                continue
+        return conn
+
+
+@contextmanager
+def conn_ctx():
+    """Leen een verbinding uit de pool; bij een pyodbc fout wordt hij vervangen."""
+    conn = _checkout()
+    broken = False
+    try:
+        yield conn
+    except pyodbc.Error:
+        broken = True
+        raise
+    finally:
+        if broken:
+            _discard(conn)
+        else:
+            _pool.put_nowait((conn, time.monotonic()))
+
+
+# ---------------------------------------------------------------------------
+# SQL statements (op module-niveau: pyodbc en de SQL Server plan cache
+# hergebruiken zo steeds exact dezelfde statement-tekst)
+# ---------------------------------------------------------------------------
+# Ontbreekt een tijdstempel in het request (None), dan zet SQL Server hem
+# via COALESCE(?, SYSUTCDATETIME()).
+SQL_INSERT_SESSION = """
+    INSERT INTO analytics_sessions (
+        visitor_id, session_id, ip_address, city, region, country, isp,
+        ip_lat, ip_lng, user_agent, platform, language, languages,
+        screen_w, screen_h, viewport_w, viewport_h, pixel_ratio,
+        color_depth, connection_type, cores, memory_gb, touch_device,
+        referrer, page_url, timezone, canvas_hash, gpu, visit_count,
+        started_at, browser
+    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,
+              COALESCE(?, SYSUTCDATETIME()),?)
+"""
+
+SQL_INSERT_EVENT = """
+    INSERT INTO analytics_events (
+        visitor_id, session_id, event_type, event_detail,
+        zoom, center_lat, center_lng, timestamp
+    ) VALUES (?,?,?,?,?,?,?,?)
+"""
+
+SQL_END_SESSION = """
+    UPDATE analytics_sessions
+    SET ended_at = COALESCE(?, SYSUTCDATETIME()), duration_seconds = ?
+    WHERE session_id = ?
+"""
+
+SQL_INSERT_EMAIL = """
+    INSERT INTO analytics_emails (
+        visitor_id, session_id, email, session_duration_min, collected_at
+    ) VALUES (?,?,?,?,COALESCE(?, SYSUTCDATETIME()))
+"""
+
+SQL_INSERT_FEEDBACK = """
+    INSERT INTO analytics_feedback (
+        visitor_id, session_id, feedback_text, email,
+        year, session_duration_min, submitted_at
+    ) VALUES (?,?,?,?,?,?,COALESCE(?, SYSUTCDATETIME()))
+"""
+
+SQL_INSERT_UPLOAD = """
+    INSERT INTO analytics_uploads (
+        upload_id, visitor_id, session_id, name, description,
+        filename, icon, color, label_column, columns_json,
+        data_json, row_count, uploaded_at
+    ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,COALESCE(?, SYSUTCDATETIME()))
+"""
+
+# TOP (?) als parameter: één query plan voor elke limit
+SQL_SESSIONS_TOP = "SELECT TOP (?) * FROM analytics_sessions ORDER BY started_at DESC"
+SQL_EVENTS_TOP = "SELECT TOP (?) * FROM analytics_events ORDER BY timestamp DESC"
+
+# Alle dashboard-statistieken in één batch; resultsets in deze volgorde
+# uitlezen met cursor.nextset(). AVG negeert NULL duration_seconds.
+# De dagen komen via CONVERT stijl 23 al als 'YYYY-MM-DD' string terug.
+SQL_STATS = """
+    SELECT COUNT(DISTINCT visitor_id), COUNT(*),
+           SUM(CASE WHEN CAST(started_at AS DATE) = CAST(GETDATE() AS DATE) THEN 1 ELSE 0 END),
+           AVG(duration_seconds)
+    FROM analytics_sessions;
+    SELECT COUNT(*) FROM analytics_emails;
+    SELECT COUNT(*) FROM analytics_events;
+    SELECT TOP 10 country, COUNT(*) as cnt FROM analytics_sessions WHERE country != '' GROUP BY country ORDER BY cnt DESC;
+    SELECT TOP 10 city, COUNT(*) as cnt FROM analytics_sessions WHERE city != '' GROUP BY city ORDER BY cnt DESC;
+    SELECT TOP 5 browser, COUNT(*) as cnt FROM analytics_sessions GROUP BY browser ORDER BY cnt DESC;
+    SELECT CONVERT(CHAR(10), CAST(started_at AS DATE), 23) as dag, COUNT(*) as cnt
+    FROM analytics_sessions
+    WHERE started_at >= DATEADD(day, -30, GETDATE())
+    GROUP BY CONVERT(CHAR(10), CAST(started_at AS DATE), 23)
+    ORDER BY dag DESC;
+"""
+
+# Vaste parametertypes voor de event-INSERT, zodat pyodbc ze bij
+# fast_executemany niet per batch via SQLDescribeParam hoeft op te vragen.
+EVENT_INPUT_SIZES = [
+    (pyodbc.SQL_VARCHAR, 100, 0),    # visitor_id
+    (pyodbc.SQL_VARCHAR, 100, 0),    # session_id
+    (pyodbc.SQL_VARCHAR, 100, 0),    # event_type
+    (pyodbc.SQL_WVARCHAR, 2000, 0),  # event_detail
+    (pyodbc.SQL_FLOAT, 0, 0),        # zoom
+    (pyodbc.SQL_FLOAT, 0, 0),        # center_lat
+    (pyodbc.SQL_FLOAT, 0, 0),        # center_lng
+    (pyodbc.SQL_VARCHAR, 50, 0),     # timestamp (ISO string)
+]
+
+# Browser-classificatie uit de user agent (volgorde telt: Edge en Opera
+# bevatten ook 'Chrome', Chrome bevat ook 'Safari'). Zelfde regels als de
+# backfill in ensure_tables().
+BROWSER_TOKENS = [
+    ('Edg/', 'Edge'),
+    ('OPR/', 'Opera'),
+    ('Opera', 'Opera'),
+    ('Firefox', 'Firefox'),
+    ('Chrome', 'Chrome'),
+    ('Safari', 'Safari'),
+]
+
+
+def classify_browser(user_agent):
+    """Bepaal de browsernaam voor de browser-kolom van analytics_sessions."""
+    for token, browser in BROWSER_TOKENS:
+        if token in user_agent:
+            return browser
+    return 'Overig'
+
+
 def ensure_tables():
     """Maak ontbrekende tabellen aan."""
     try:
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("""
-            IF NOT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'analytics_uploads')
-            BEGIN
-                CREATE TABLE analytics_uploads (
-                    id              INT IDENTITY(1,1) PRIMARY KEY,
-                    upload_id       VARCHAR(100) NOT NULL,
-                    visitor_id      VARCHAR(100) DEFAULT '',
-                    session_id      VARCHAR(100) DEFAULT '',
-                    name            NVARCHAR(500) DEFAULT '',
-                    description     NVARCHAR(2000) DEFAULT '',
-                    filename        NVARCHAR(500) DEFAULT '',
-                    icon            VARCHAR(50) DEFAULT 'location_on',
-                    color           VARCHAR(20) DEFAULT '#e11d48',
-                    label_column    NVARCHAR(100) DEFAULT '',
-                    columns_json    NVARCHAR(MAX) DEFAULT '[]',
-                    data_json       NVARCHAR(MAX) DEFAULT '[]',
-                    row_count       INT DEFAULT 0,
-                    uploaded_at     DATETIME2 DEFAULT GETUTCDATE()
-                );
-                CREATE INDEX IX_uploads_upload_id ON analytics_uploads(upload_id);
-                CREATE INDEX IX_uploads_uploaded_at ON analytics_uploads(uploaded_at);
-                PRINT 'Tabel analytics_uploads aangemaakt';
-            END
-            -- Kolommen toevoegen als ze nog niet bestaan (bestaande tabellen)
-            IF NOT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME='analytics_uploads' AND COLUMN_NAME='name')
-                ALTER TABLE analytics_uploads ADD name NVARCHAR(500) DEFAULT '';
-            IF NOT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME='analytics_uploads' AND COLUMN_NAME='description')
-                ALTER TABLE analytics_uploads ADD description NVARCHAR(2000) DEFAULT '';
-        """)
-        conn.close()
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                IF NOT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = 'analytics_uploads')
+                BEGIN
+                    CREATE TABLE analytics_uploads (
+                        id              INT IDENTITY(1,1) PRIMARY KEY,
+                        upload_id       VARCHAR(100) NOT NULL,
+                        visitor_id      VARCHAR(100) DEFAULT '',
+                        session_id      VARCHAR(100) DEFAULT '',
+                        name            NVARCHAR(500) DEFAULT '',
+                        description     NVARCHAR(2000) DEFAULT '',
+                        filename        NVARCHAR(500) DEFAULT '',
+                        icon            VARCHAR(50) DEFAULT 'location_on',
+                        color           VARCHAR(20) DEFAULT '#e11d48',
+                        label_column    NVARCHAR(100) DEFAULT '',
+                        columns_json    NVARCHAR(MAX) DEFAULT '[]',
+                        data_json       NVARCHAR(MAX) DEFAULT '[]',
+                        row_count       INT DEFAULT 0,
+                        uploaded_at     DATETIME2 DEFAULT GETUTCDATE()
+                    );
+                    CREATE INDEX IX_uploads_upload_id ON analytics_uploads(upload_id);
+                    CREATE INDEX IX_uploads_uploaded_at ON analytics_uploads(uploaded_at);
+                    PRINT 'Tabel analytics_uploads aangemaakt';
+                END
+                -- Kolommen toevoegen als ze nog niet bestaan (bestaande tabellen)
+                IF NOT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME='analytics_uploads' AND COLUMN_NAME='name')
+                    ALTER TABLE analytics_uploads ADD name NVARCHAR(500) DEFAULT '';
+                IF NOT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME='analytics_uploads' AND COLUMN_NAME='description')
+                    ALTER TABLE analytics_uploads ADD description NVARCHAR(2000) DEFAULT '';
+            """)
+            # Browser als gematerialiseerde kolom (wordt bij insert gevuld),
+            # zodat /api/admin/stats niet elke keer alle user agents scant.
+            # EXEC(): de kolom bestaat nog niet wanneer de batch gecompileerd wordt.
+            cursor.execute("""
+                IF NOT EXISTS (SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME='analytics_sessions' AND COLUMN_NAME='browser')
+                    ALTER TABLE analytics_sessions ADD browser VARCHAR(16) NULL;
+                IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_sessions_browser')
+                    EXEC('CREATE INDEX IX_sessions_browser ON analytics_sessions(browser)');
+                -- Eenmalige backfill van bestaande sessies
+                EXEC('
+                    UPDATE analytics_sessions SET browser =
+                        CASE
+                            WHEN user_agent LIKE ''%Edg/%'' THEN ''Edge''
+                            WHEN user_agent LIKE ''%OPR/%'' OR user_agent LIKE ''%Opera%'' THEN ''Opera''
+                            WHEN user_agent LIKE ''%Firefox%'' THEN ''Firefox''
+                            WHEN user_agent LIKE ''%Chrome%'' THEN ''Chrome''
+                            WHEN user_agent LIKE ''%Safari%'' THEN ''Safari''
+                            ELSE ''Overig''
+                        END
+                    WHERE browser IS NULL
+                ');
+            """)
+            # Indexen voor de admin-queries: TOP N ... ORDER BY tijd DESC en de
+            # 30-dagen/land/stad aggregaties worden zo index seeks i.p.v. scans.
+            cursor.execute("""
+                IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_sessions_started_desc' AND object_id=OBJECT_ID('analytics_sessions'))
+                    CREATE INDEX IX_sessions_started_desc ON analytics_sessions(started_at DESC)
+                        INCLUDE (visitor_id, country, city, user_agent, duration_seconds);
+                IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_sessions_country' AND object_id=OBJECT_ID('analytics_sessions'))
+                    CREATE INDEX IX_sessions_country ON analytics_sessions(country) WHERE country <> '';
+                IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_sessions_city' AND object_id=OBJECT_ID('analytics_sessions'))
+                    CREATE INDEX IX_sessions_city ON analytics_sessions(city) WHERE city <> '';
+                IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_events_ts_desc' AND object_id=OBJECT_ID('analytics_events'))
+                    CREATE INDEX IX_events_ts_desc ON analytics_events(timestamp DESC);
+            """)
     except Exception as e:
         print(f"  Tabel-check fout (niet kritiek): {e}")
 
@@ -79,17 +306,162 @@ def ensure_tables():
 def test_connection():
     """Test de database verbinding bij opstarten."""
     try:
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM analytics_sessions")
-        count = cursor.fetchone()[0]
-        conn.close()
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM analytics_sessions")
+            count = cursor.fetchone()[0]
         print(f"  Database OK: {count} sessies in analytics_sessions")
         return True
     except Exception as e:
         print(f"  Database FOUT: {e}")
         return False
 
+# ---------------------------------------------------------------------------
+# Event wachtrij
+# ---------------------------------------------------------------------------
+# /api/event(s) zetten rijen in een wachtrij en antwoorden direct met 202;
+# een achtergrondthread schrijft ze gebundeld weg met één executemany.
+EVENT_FLUSH_INTERVAL = 0.2  # seconden, max wachttijd voor een batch
+EVENT_FLUSH_ROWS = 500      # max rijen per flush
+EVENT_BATCH_ROWS = 1000     # max rijen per executemany-aanroep
+EVENT_FLUSH_RETRIES = 3     # pogingen per batch voordat die naar schijf gaat
+# Batches die ook na de retries niet in de DB komen (client had al 202)
+EVENT_SPILL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'events_unsaved.jsonl')
+
+_event_queue = queue.Queue()
+_event_flush_lock = threading.Lock()
+_EVENT_STOP = object()  # sentinel: flusher schrijft zijn batch weg en stopt
+_event_flusher_thread = None
+_event_flusher_start_lock = threading.Lock()
+
+
+def _event_row(d):
+    """Zet een event-dict om naar een parameter-tuple voor de INSERT.
+
+    De tijd wordt alleen bepaald als de client geen timestamp meestuurt; hier
+    in Python en niet in SQL, omdat de wachtrij het schrijven vertraagt.
+    """
+    return (
+        d.get('visitor_id',''), d.get('session_id',''),
+        d.get('event_type',''), (d.get('event_detail',''))[:2000],
+        d.get('zoom'), d.get('center_lat'), d.get('center_lng'),
+        d.get('timestamp') or datetime.datetime.utcnow().isoformat()
+    )
+
+
+def _write_events(params):
+    """Schrijf event-rijen weg met fast_executemany in één transactie."""
+    with conn_ctx() as conn:
+        cursor = conn.cursor()
+        # Parameter-arrays in één TDS-roundtrip i.p.v. één per rij
+        cursor.fast_executemany = True
+        cursor.setinputsizes(EVENT_INPUT_SIZES)
+        # Eén transactie voor de hele batch: één log-flush i.p.v. per rij
+        conn.autocommit = False
+        try:
+            for i in range(0, len(params), EVENT_BATCH_ROWS):
+                cursor.executemany(SQL_INSERT_EVENT, params[i:i + EVENT_BATCH_ROWS])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+
+
+def _flush_batch(batch):
+    """Schrijf een batch weg, met retries (de client heeft al 202).
+
+    Lukt het ook na EVENT_FLUSH_RETRIES pogingen niet, dan gaan de rijen naar
+    EVENT_SPILL_FILE zodat ze later alsnog ingelezen kunnen worden.
+    """
+    for attempt in range(1, EVENT_FLUSH_RETRIES + 1):
+        try:
+            _write_events(batch)
+            return
+        except Exception as e:
+            print(f"  Events flush fout (poging {attempt}/{EVENT_FLUSH_RETRIES}, {len(batch)} events): {e}")
+            if attempt < EVENT_FLUSH_RETRIES:
+                time.sleep(attempt)
+    try:
+        with open(EVENT_SPILL_FILE, 'ab') as fh:
+            for row in batch:
+                fh.write(orjson.dumps(row, option=orjson.OPT_APPEND_NEWLINE))
+        print(f"  {len(batch)} events bewaard in {EVENT_SPILL_FILE}")
+    except OSError as e:
+        print(f"  Events VERLOREN ({len(batch)}): kan {EVENT_SPILL_FILE} niet schrijven: {e}")
+
+
+def _event_flusher():
+    """Achtergrondthread: verzamel events tot EVENT_FLUSH_ROWS of EVENT_FLUSH_INTERVAL.
+
+    Stopt bij _EVENT_STOP, maar pas nadat de batch in handen is weggeschreven.
+    """
+    stopping = False
+    while not stopping:
+        item = _event_queue.get()
+        if item is _EVENT_STOP:
+            break
+        batch = [item]
+        deadline = time.monotonic() + EVENT_FLUSH_INTERVAL
+        while len(batch) < EVENT_FLUSH_ROWS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _event_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _EVENT_STOP:
+                stopping = True
+                break
+            batch.append(item)
+        with _event_flush_lock:
+            _flush_batch(batch)
+
+
+def start_event_flusher():
+    """Start de flusher-thread (eenmalig, in het proces dat requests afhandelt).
+
+    Niet bij import: met debug=True importeert ook het reloader-ouderproces
+    deze module, en dat handelt geen requests af.
+    """
+    global _event_flusher_thread
+    if _event_flusher_thread is not None:
+        return
+    with _event_flusher_start_lock:
+        if _event_flusher_thread is None:
+            thread = threading.Thread(target=_event_flusher, name='event-flusher', daemon=True)
+            thread.start()
+            _event_flusher_thread = thread
+
+
+def flush_events():
+    """Stop de flusher en schrijf alles wat nog wacht weg (bij afsluiten).
+
+    De flusher krijgt eerst een stop-signaal en wordt gejoind, zodat zijn
+    lopende batch niet verloren gaat; daarna wordt de rest van de wachtrij
+    leeggeschreven.
+    """
+    thread = _event_flusher_thread
+    if thread is not None and thread.is_alive():
+        _event_queue.put(_EVENT_STOP)
+        thread.join()
+    with _event_flush_lock:
+        batch = []
+        while True:
+            try:
+                item = _event_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _EVENT_STOP:
+                batch.append(item)
+        if batch:
+            print(f"  {len(batch)} events uit wachtrij opslaan...")
+            for i in range(0, len(batch), EVENT_FLUSH_ROWS):
+                _flush_batch(batch[i:i + EVENT_FLUSH_ROWS])
+
+
 # ---------------------------------------------------------------------------
 # API Endpoints
 # ---------------------------------------------------------------------------
@@ -98,8 +470,8 @@ def test_connection():
 def health():
     """Health check endpoint."""
     try:
-        conn = get_conn()
-        conn.close()
+        with conn_ctx():
+            pass
         return jsonify({'status': 'ok', 'database': DB_NAME, 'server': DB_SERVER})
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -110,35 +482,30 @@ def create_session():
     """Registreer een nieuwe bezoekersessie."""
     try:
         d = request.get_json(force=True)
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO analytics_sessions (
-                visitor_id, session_id, ip_address, city, region, country, isp,
-                ip_lat, ip_lng, user_agent, platform, language, languages,
-                screen_w, screen_h, viewport_w, viewport_h, pixel_ratio,
-                color_depth, connection_type, cores, memory_gb, touch_device,
-                referrer, page_url, timezone, canvas_hash, gpu, visit_count,
-                started_at
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (
-            d.get('visitor_id',''), d.get('session_id',''),
-            d.get('ip_address',''), d.get('city',''), d.get('region',''),
-            d.get('country',''), d.get('isp',''),
-            d.get('ip_lat'), d.get('ip_lng'),
-            (d.get('user_agent',''))[:500], d.get('platform',''),
-            d.get('language',''), d.get('languages',''),
-            d.get('screen_w'), d.get('screen_h'),
-            d.get('viewport_w'), d.get('viewport_h'),
-            d.get('pixel_ratio'), d.get('color_depth'),
-            d.get('connection_type',''), d.get('cores'),
-            d.get('memory_gb'), d.get('touch_device', False),
-            (d.get('referrer',''))[:500], (d.get('page_url',''))[:500],
-            d.get('timezone',''), d.get('canvas_hash',''),
-            (d.get('gpu',''))[:200], d.get('visit_count', 1),
-            d.get('started_at', datetime.datetime.utcnow().isoformat())
-        ))
-        conn.close()
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            user_agent = d.get('user_agent', '')
+            # De [:N] slices hieronder kosten niets voor waarden binnen de limiet
+            # (CPython geeft dan hetzelfde str-object terug) en voorkomen een
+            # 'String data, right truncation' fout bij te lange waarden.
+            cursor.execute(SQL_INSERT_SESSION, (
+                d.get('visitor_id',''), d.get('session_id',''),
+                d.get('ip_address',''), d.get('city',''), d.get('region',''),
+                d.get('country',''), d.get('isp',''),
+                d.get('ip_lat'), d.get('ip_lng'),
+                user_agent[:500], d.get('platform',''),
+                d.get('language',''), d.get('languages',''),
+                d.get('screen_w'), d.get('screen_h'),
+                d.get('viewport_w'), d.get('viewport_h'),
+                d.get('pixel_ratio'), d.get('color_depth'),
+                d.get('connection_type',''), d.get('cores'),
+                d.get('memory_gb'), d.get('touch_device', False),
+                (d.get('referrer',''))[:500], (d.get('page_url',''))[:500],
+                d.get('timezone',''), d.get('canvas_hash',''),
+                (d.get('gpu',''))[:200], d.get('visit_count', 1),
+                d.get('started_at'),
+                classify_browser(user_agent)
+            ))
         return jsonify({'status': 'ok'}), 201
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -146,51 +513,27 @@ def create_session():
 
 @app.route('/api/event', methods=['POST'])
 def create_event():
-    """Registreer een event."""
+    """Registreer een event (asynchroon via de event-wachtrij)."""
     try:
         d = request.get_json(force=True)
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO analytics_events (
-                visitor_id, session_id, event_type, event_detail,
-                zoom, center_lat, center_lng, timestamp
-            ) VALUES (?,?,?,?,?,?,?,?)
-        """, (
-            d.get('visitor_id',''), d.get('session_id',''),
-            d.get('event_type',''), (d.get('event_detail',''))[:2000],
-            d.get('zoom'), d.get('center_lat'), d.get('center_lng'),
-            d.get('timestamp', datetime.datetime.utcnow().isoformat())
-        ))
-        conn.close()
-        return jsonify({'status': 'ok'}), 201
+        start_event_flusher()
+        _event_queue.put(_event_row(d))
+        return jsonify({'status': 'accepted'}), 202
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
 
 @app.route('/api/events', methods=['POST'])
 def create_events_batch():
-    """Registreer meerdere events tegelijk (batch)."""
+    """Registreer meerdere events tegelijk (batch, asynchroon)."""
     try:
         events = request.get_json(force=True)
         if not isinstance(events, list):
             events = [events]
-        conn = get_conn()
-        cursor = conn.cursor()
+        start_event_flusher()
         for d in events:
-            cursor.execute("""
-                INSERT INTO analytics_events (
-                    visitor_id, session_id, event_type, event_detail,
-                    zoom, center_lat, center_lng, timestamp
-                ) VALUES (?,?,?,?,?,?,?,?)
-            """, (
-                d.get('visitor_id',''), d.get('session_id',''),
-                d.get('event_type',''), (d.get('event_detail',''))[:2000],
-                d.get('zoom'), d.get('center_lat'), d.get('center_lng'),
-                d.get('timestamp', datetime.datetime.utcnow().isoformat())
-            ))
-        conn.close()
-        return jsonify({'status': 'ok', 'count': len(events)}), 201
+            _event_queue.put(_event_row(d))
+        return jsonify({'status': 'accepted', 'count': len(events)}), 202
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
@@ -200,18 +543,13 @@ def session_end():
     """Update sessie met eindtijd en duur."""
     try:
         d = request.get_json(force=True)
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE analytics_sessions
-            SET ended_at = ?, duration_seconds = ?
-            WHERE session_id = ?
-        """, (
-            d.get('ended_at', datetime.datetime.utcnow().isoformat()),
-            d.get('duration_seconds', 0),
-            d.get('session_id', '')
-        ))
-        conn.close()
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_END_SESSION, (
+                d.get('ended_at'),
+                d.get('duration_seconds', 0),
+                d.get('session_id', '')
+            ))
         return jsonify({'status': 'ok'}), 200
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -222,18 +560,13 @@ def save_email():
     """Sla een e-mailadres op."""
     try:
         d = request.get_json(force=True)
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO analytics_emails (
-                visitor_id, session_id, email, session_duration_min, collected_at
-            ) VALUES (?,?,?,?,?)
-        """, (
-            d.get('visitor_id',''), d.get('session_id',''),
-            d.get('email',''), d.get('session_duration_min', 0),
-            d.get('collected_at', datetime.datetime.utcnow().isoformat())
-        ))
-        conn.close()
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_INSERT_EMAIL, (
+                d.get('visitor_id',''), d.get('session_id',''),
+                d.get('email',''), d.get('session_duration_min', 0),
+                d.get('collected_at')
+            ))
         return jsonify({'status': 'ok'}), 201
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -244,20 +577,14 @@ def save_feedback():
     """Sla feedback op."""
     try:
         d = request.get_json(force=True)
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO analytics_feedback (
-                visitor_id, session_id, feedback_text, email,
-                year, session_duration_min, submitted_at
-            ) VALUES (?,?,?,?,?,?,?)
-        """, (
-            d.get('visitor_id',''), d.get('session_id',''),
-            d.get('text',''), d.get('email',''),
-            d.get('year'), d.get('session_duration_min', 0),
-            d.get('submitted_at', datetime.datetime.utcnow().isoformat())
-        ))
-        conn.close()
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_INSERT_FEEDBACK, (
+                d.get('visitor_id',''), d.get('session_id',''),
+                d.get('text',''), d.get('email',''),
+                d.get('year'), d.get('session_duration_min', 0),
+                d.get('submitted_at')
+            ))
         return jsonify({'status': 'ok'}), 201
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -267,23 +594,38 @@ def save_feedback():
 # Admin Endpoints (alleen voor dashboard)
 # ---------------------------------------------------------------------------
 
+def _json_default(obj):
+    """orjson fallback voor types die het niet zelf kent (DECIMAL kolommen)."""
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    raise TypeError
+
+
+def rows_response(cursor):
+    """Serialiseer alle rijen van een cursor als JSON array met orjson.
+
+    orjson schrijft datetime objecten zelf als ISO 8601, dus een aparte
+    isoformat-pass over alle cellen is niet nodig.
+    """
+    columns = tuple(col[0] for col in cursor.description)
+    rows = []
+    while True:
+        chunk = cursor.fetchmany(1000)
+        if not chunk:
+            break
+        rows.extend(dict(zip(columns, row)) for row in chunk)
+    return Response(orjson.dumps(rows, default=_json_default), mimetype='application/json')
+
+
 @app.route('/api/admin/sessions', methods=['GET'])
 def get_sessions():
     """Haal sessies op (nieuwste eerst)."""
     try:
         limit = request.args.get('limit', 100, type=int)
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT TOP {limit} * FROM analytics_sessions ORDER BY started_at DESC")
-        columns = [col[0] for col in cursor.description]
-        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        conn.close()
-        # Serialiseer datetime objecten
-        for row in rows:
-            for k, v in row.items():
-                if isinstance(v, datetime.datetime):
-                    row[k] = v.isoformat()
-        return jsonify(rows)
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_SESSIONS_TOP, limit)
+            return rows_response(cursor)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -293,17 +635,10 @@ def get_events():
     """Haal events op (nieuwste eerst)."""
     try:
         limit = request.args.get('limit', 200, type=int)
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT TOP {limit} * FROM analytics_events ORDER BY timestamp DESC")
-        columns = [col[0] for col in cursor.description]
-        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        conn.close()
-        for row in rows:
-            for k, v in row.items():
-                if isinstance(v, datetime.datetime):
-                    row[k] = v.isoformat()
-        return jsonify(rows)
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_EVENTS_TOP, limit)
+            return rows_response(cursor)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -312,93 +647,63 @@ def get_events():
 def get_emails():
     """Haal e-mails op."""
     try:
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM analytics_emails ORDER BY collected_at DESC")
-        columns = [col[0] for col in cursor.description]
-        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        conn.close()
-        for row in rows:
-            for k, v in row.items():
-                if isinstance(v, datetime.datetime):
-                    row[k] = v.isoformat()
-        return jsonify(rows)
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM analytics_emails ORDER BY collected_at DESC")
+            return rows_response(cursor)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+# Stats veranderen op mensen-tijdschaal; dashboard-polls binnen de TTL
+# krijgen het vorige resultaat i.p.v. opnieuw alle aggregaties.
+STATS_CACHE_TTL = 30  # seconden
+_stats_cache = {'t': 0.0, 'v': None}
+
+
 @app.route('/api/admin/stats', methods=['GET'])
 def get_stats():
-    """Samenvattende statistieken."""
+    """Samenvattende statistieken (gecached voor STATS_CACHE_TTL seconden)."""
+    if _stats_cache['v'] is not None and time.monotonic() - _stats_cache['t'] < STATS_CACHE_TTL:
+        return jsonify(_stats_cache['v'])
     try:
-        conn = get_conn()
-        cursor = conn.cursor()
-        stats = {}
-
-        cursor.execute("SELECT COUNT(DISTINCT visitor_id) FROM analytics_sessions")
-        stats['unique_visitors'] = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM analytics_sessions")
-        stats['total_sessions'] = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM analytics_sessions WHERE CAST(started_at AS DATE) = CAST(GETDATE() AS DATE)")
-        stats['today_sessions'] = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM analytics_emails")
-        stats['total_emails'] = cursor.fetchone()[0]
-
-        cursor.execute("SELECT COUNT(*) FROM analytics_events")
-        stats['total_events'] = cursor.fetchone()[0]
-
-        cursor.execute("SELECT AVG(duration_seconds) FROM analytics_sessions WHERE duration_seconds IS NOT NULL")
-        avg_dur = cursor.fetchone()[0]
-        stats['avg_duration_seconds'] = int(avg_dur) if avg_dur else 0
-
-        # Top landen
-        cursor.execute("SELECT TOP 10 country, COUNT(*) as cnt FROM analytics_sessions WHERE country != '' GROUP BY country ORDER BY cnt DESC")
-        stats['top_countries'] = [{'country': r[0], 'count': r[1]} for r in cursor.fetchall()]
-
-        # Top steden
-        cursor.execute("SELECT TOP 10 city, COUNT(*) as cnt FROM analytics_sessions WHERE city != '' GROUP BY city ORDER BY cnt DESC")
-        stats['top_cities'] = [{'city': r[0], 'count': r[1]} for r in cursor.fetchall()]
-
-        # Top browsers
-        cursor.execute("""
-            SELECT TOP 5
-                CASE
-                    WHEN user_agent LIKE '%Edg/%' THEN 'Edge'
-                    WHEN user_agent LIKE '%OPR/%' OR user_agent LIKE '%Opera%' THEN 'Opera'
-                    WHEN user_agent LIKE '%Firefox%' THEN 'Firefox'
-                    WHEN user_agent LIKE '%Chrome%' THEN 'Chrome'
-                    WHEN user_agent LIKE '%Safari%' THEN 'Safari'
-                    ELSE 'Overig'
-                END as browser,
-                COUNT(*) as cnt
-            FROM analytics_sessions
-            GROUP BY
-                CASE
-                    WHEN user_agent LIKE '%Edg/%' THEN 'Edge'
-                    WHEN user_agent LIKE '%OPR/%' OR user_agent LIKE '%Opera%' THEN 'Opera'
-                    WHEN user_agent LIKE '%Firefox%' THEN 'Firefox'
-                    WHEN user_agent LIKE '%Chrome%' THEN 'Chrome'
-                    WHEN user_agent LIKE '%Safari%' THEN 'Safari'
-                    ELSE 'Overig'
-                END
-            ORDER BY cnt DESC
-        """)
-        stats['top_browsers'] = [{'browser': r[0], 'count': r[1]} for r in cursor.fetchall()]
-
-        # Sessies per dag (laatste 30 dagen)
-        cursor.execute("""
-            SELECT CAST(started_at AS DATE) as dag, COUNT(*) as cnt
-            FROM analytics_sessions
-            WHERE started_at >= DATEADD(day, -30, GETDATE())
-            GROUP BY CAST(started_at AS DATE)
-            ORDER BY dag DESC
-        """)
-        stats['daily'] = [{'date': r[0].isoformat(), 'count': r[1]} for r in cursor.fetchall()]
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            # Eén batch met meerdere resultsets: één roundtrip i.p.v. negen
+            cursor.execute(SQL_STATS)
+            stats = {}
 
-        conn.close()
+            unique_visitors, total_sessions, today_sessions, avg_dur = cursor.fetchone()
+            stats['unique_visitors'] = unique_visitors
+            stats['total_sessions'] = total_sessions
+            stats['today_sessions'] = today_sessions or 0
+
+            cursor.nextset()
+            stats['total_emails'] = cursor.fetchone()[0]
+
+            cursor.nextset()
+            stats['total_events'] = cursor.fetchone()[0]
+
+            stats['avg_duration_seconds'] = int(avg_dur) if avg_dur else 0
+
+            # Top landen
+            cursor.nextset()
+            stats['top_countries'] = [{'country': r[0], 'count': r[1]} for r in cursor.fetchall()]
+
+            # Top steden
+            cursor.nextset()
+            stats['top_cities'] = [{'city': r[0], 'count': r[1]} for r in cursor.fetchall()]
+
+            # Top browsers
+            cursor.nextset()
+            stats['top_browsers'] = [{'browser': r[0], 'count': r[1]} for r in cursor.fetchall()]
+
+            # Sessies per dag (laatste 30 dagen)
+            cursor.nextset()
+            stats['daily'] = [{'date': r[0], 'count': r[1]} for r in cursor.fetchall()]
+
+        _stats_cache['t'] = time.monotonic()
+        _stats_cache['v'] = stats
         return jsonify(stats)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -408,17 +713,10 @@ def get_stats():
 def get_feedback():
     """Haal feedback op."""
     try:
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM analytics_feedback ORDER BY submitted_at DESC")
-        columns = [col[0] for col in cursor.description]
-        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        conn.close()
-        for row in rows:
-            for k, v in row.items():
-                if isinstance(v, datetime.datetime):
-                    row[k] = v.isoformat()
-        return jsonify(rows)
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM analytics_feedback ORDER BY submitted_at DESC")
+            return rows_response(cursor)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -432,24 +730,17 @@ def save_upload():
     """Sla een gebruikers-upload op (metadata + data als JSON)."""
     try:
         d = request.get_json(force=True)
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO analytics_uploads (
-                upload_id, visitor_id, session_id, name, description,
-                filename, icon, color, label_column, columns_json,
-                data_json, row_count, uploaded_at
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)
-        """, (
-            d.get('upload_id', ''), d.get('visitor_id', ''),
-            d.get('session_id', ''), d.get('name', ''),
-            d.get('description', ''), d.get('filename', ''),
-            d.get('icon', 'location_on'), d.get('color', '#e11d48'),
-            d.get('label_column', ''), d.get('columns_json', '[]'),
-            d.get('data_json', '[]'), d.get('row_count', 0),
-            d.get('uploaded_at', datetime.datetime.utcnow().isoformat())
-        ))
-        conn.close()
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_INSERT_UPLOAD, (
+                d.get('upload_id', ''), d.get('visitor_id', ''),
+                d.get('session_id', ''), d.get('name', ''),
+                d.get('description', ''), d.get('filename', ''),
+                d.get('icon', 'location_on'), d.get('color', '#e11d48'),
+                d.get('label_column', ''), d.get('columns_json', '[]'),
+                d.get('data_json', '[]'), d.get('row_count', 0),
+                d.get('uploaded_at')
+            ))
         return jsonify({'status': 'ok'}), 201
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -459,17 +750,10 @@ def save_upload():
 def get_uploads():
     """Haal alle uploads op (admin)."""
     try:
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM analytics_uploads ORDER BY uploaded_at DESC")
-        columns = [col[0] for col in cursor.description]
-        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
-        conn.close()
-        for row in rows:
-            for k, v in row.items():
-                if isinstance(v, datetime.datetime):
-                    row[k] = v.isoformat()
-        return jsonify(rows)
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM analytics_uploads ORDER BY uploaded_at DESC")
+            return rows_response(cursor)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -478,10 +762,9 @@ def get_uploads():
 def delete_upload(upload_id):
     """Verwijder een upload (admin)."""
     try:
-        conn = get_conn()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM analytics_uploads WHERE upload_id = ?", (upload_id,))
-        conn.close()
+        with conn_ctx() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM analytics_uploads WHERE upload_id = ?", (upload_id,))
         return jsonify({'status': 'ok'}), 200
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
@@ -495,6 +778,9 @@ if __name__ == '__main__':
     print("  GeoInzicht Analytics API")
     print("=" * 50)
     print(f"  Database: {DB_SERVER}/{DB_NAME}")
+    # Wachtrij leegschrijven bij afsluiten (Ctrl+C of SIGTERM)
+    atexit.register(flush_events)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     test_connection()
     ensure_tables()
     print(f"  API draait op http://localhost:5000")
@@ -502,4 +788,7 @@ if __name__ == '__main__':
     print("=" * 50)
     # BEVEILIGINGSTIP: host='127.0.0.1' = alleen lokaal bereikbaar
     # Gebruik '0.0.0.0' alleen als je de API van buitenaf wilt bereiken
-    app.run(host='127.0.0.1', port=5000, debug=True)
+    # threaded=True: elke request in een eigen thread. pyodbc geeft de GIL vrij
+    # tijdens de SQL Server roundtrip, dus DB-wachttijd van requests overlapt;
+    # de connection pool (DB_POOL_SIZE) begrenst hoeveel er tegelijk de DB raken.
+    app.run(host='127.0.0.1', port=5000, debug=True, threaded=True)
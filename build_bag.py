@@ -10,20 +10,30 @@ Usage:
     python build_bag.py --naam "Utrecht"             # Zoek op naam
     python build_bag.py --all                        # Alle gemeenten
     python build_bag.py --list gemeenten.txt         # Lijst van gemeentecodes
+    python build_bag.py --all --workers 4            # 4 gemeenten tegelijk
+    python build_bag.py --all --gzip                 # Ook .geojson.gz schrijven
 
 Dependencies:
-    pip install requests
+    pip install requests orjson
 """
 
 import argparse
+import concurrent.futures
+import gzip
 import json
 import logging
 import os
 import re
 import sys
+import threading
 import time
+from collections import Counter
+from contextlib import nullcontext
+from itertools import islice
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 
 # ---------------------------------------------------------------------------
 # Configuration
@@ -32,7 +42,12 @@ PDOK_BAG_WFS = "https://service.pdok.nl/lv/bag/wfs/v2_0"
 PAGE_SIZE = 1000  # PDOK hard limit
 MAX_RETRIES = 3
 RETRY_DELAY = 5  # seconds
+WRITE_CHUNK = 5000  # Features per orjson.dumps bij het schrijven
 CONCURRENCY = 1  # Sequential to avoid PDOK throttling
+WORKERS = 4  # Gemeenten tegelijk; pagina's binnen een gemeente blijven sequentieel
+# Gedeeld over alle gemeenten (en de vooruit-downloads), ongeacht --workers
+MAX_IN_FLIGHT = 4  # PDOK-requests tegelijk in de lucht
+REQUEST_INTERVAL = 0.25  # Min. seconden tussen twee request-starts (~4 req/s)
 
 # Velden om op te slaan per adres
 BAG_FIELDS = [
@@ -42,6 +57,13 @@ BAG_FIELDS = [
     "pandstatus",
 ]
 
+# Gedeelde sessie: keep-alive hergebruikt TCP/TLS verbindingen over alle pagina's.
+# Retries doen we zelf (MAX_RETRIES), dus niet in de adapter.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=0))
+# Geen "br": requests pakt brotli alleen uit als het brotli-pakket er is
+SESSION.headers.update({"Accept-Encoding": "gzip, deflate", "User-Agent": "geoinzicht-build/1.0"})
+
 # Output directory
 OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bag")
 
@@ -64,8 +86,8 @@ def load_gemeenten_geojson():
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                             f"gemeenten_{year}.geojson")
         if os.path.exists(path):
-            with open(path, "r", encoding="utf-8") as f:
-                data = json.load(f)
+            with open(path, "rb") as f:
+                data = orjson.loads(f.read())
             log.info(f"Gemeenten geladen uit gemeenten_{year}.geojson ({len(data['features'])} features)")
             return data
     raise FileNotFoundError("Geen gemeenten_YYYY.geojson gevonden. Bouw eerst: python build_geojson.py --type gemeenten --year 2022")
@@ -90,12 +112,36 @@ def get_gemeente_bbox(feature):
     if not coords:
         return None
 
-    lngs = [c[0] for c in coords]
-    lats = [c[1] for c in coords]
+    # Kolommen in één transpositie i.p.v. twee list comprehensions
+    lngs, lats = list(zip(*coords))[:2]
     # BBOX format for PDOK: south,west,north,east,EPSG:4326
     return f"{min(lats):.6f},{min(lngs):.6f},{max(lats):.6f},{max(lngs):.6f},EPSG:4326"
 
 
+_rate_lock = threading.Lock()
+_next_request = 0.0
+_in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+
+def pdok_get(params, timeout):
+    """SESSION.get via de gedeelde throttle.
+
+    Token bucket over alle threads (hooguit één request-start per
+    REQUEST_INTERVAL) plus een plafond van MAX_IN_FLIGHT lopende requests.
+    """
+    global _next_request
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_request - now
+        _next_request = max(now, _next_request) + REQUEST_INTERVAL
+    if wait > 0:
+        time.sleep(wait)
+    with _in_flight:
+        resp = SESSION.get(PDOK_BAG_WFS, params=params, timeout=timeout)
+    resp.raise_for_status()
+    return resp
+
+
 def count_features(bbox):
     """Get total count of BAG features in bbox via resultType=hits."""
     params = {
@@ -107,8 +153,7 @@ def count_features(bbox):
     }
     for attempt in range(MAX_RETRIES):
         try:
-            resp = requests.get(PDOK_BAG_WFS, params=params, timeout=30)
-            resp.raise_for_status()
+            resp = pdok_get(params, timeout=30)
             m = re.search(r'numberMatched="(\d+)"', resp.text)
             return int(m.group(1)) if m else -1
         except Exception as e:
@@ -133,9 +178,9 @@ def download_page(bbox, start_index, timeout=120):
     }
     for attempt in range(MAX_RETRIES):
         try:
-            resp = requests.get(PDOK_BAG_WFS, params=params, timeout=timeout)
-            resp.raise_for_status()
-            data = resp.json()
+            resp = pdok_get(params, timeout=timeout)
+            # orjson direct op de bytes: sneller dan resp.json() (decode + stdlib json)
+            data = orjson.loads(resp.content)
             return data.get("features", [])
         except Exception as e:
             if attempt < MAX_RETRIES - 1:
@@ -147,34 +192,84 @@ def download_page(bbox, start_index, timeout=120):
                 return []
 
 
-def clean_feature(feature):
-    """Strip feature to only needed properties and round coordinates."""
-    props = feature.get("properties", {})
-    geom = feature.get("geometry")
-    if not geom or not props.get("identificatie"):
-        return None
-
-    clean = {}
-    for field in BAG_FIELDS:
-        val = props.get(field)
-        if val is not None:
-            clean[field] = val
-
-    # Round coordinates to 6 decimals (11cm precision)
-    if geom.get("coordinates"):
-        coords = geom["coordinates"]
-        if isinstance(coords[0], (int, float)):
-            coords = [round(c, 6) for c in coords]
-        geom["coordinates"] = coords
-
-    return {
-        "type": "Feature",
-        "properties": clean,
-        "geometry": geom,
-    }
-
-
-def build_gemeente(gemeente_code, gemeente_naam, bbox, output_dir=None):
+def round_coords(coords):
+    """Round (nested) coordinates to 6 decimals; Point is the fast path."""
+    if isinstance(coords[0], (int, float)):
+        if len(coords) == 2:
+            return [round(coords[0], 6), round(coords[1], 6)]
+        return [round(c, 6) for c in coords]
+    return [round_coords(c) for c in coords]
+
+
+def new_columns():
+    """Empty column store (SoA): one list per BAG field plus geometry."""
+    cols = {field: [] for field in BAG_FIELDS}
+    cols["geometry"] = []
+    return cols
+
+
+def append_page(cols, seen, features):
+    """Clean and deduplicate one page straight into the column store.
+
+    Only the needed fields are kept, coordinates are rounded; the raw page
+    dicts can be dropped right after. Returns the number of new features.
+    """
+    added = 0
+    for feature in features:
+        props = feature.get("properties", {})
+        geom = feature.get("geometry")
+        fid = props.get("identificatie")
+        if not geom or not fid or fid in seen:
+            continue
+        seen.add(fid)
+        for field in BAG_FIELDS:
+            cols[field].append(props.get(field))
+
+        # Round coordinates to 6 decimals (11cm precision)
+        if geom.get("coordinates"):
+            geom["coordinates"] = round_coords(geom["coordinates"])
+        cols["geometry"].append(geom)
+        added += 1
+    return added
+
+
+def iter_features(cols):
+    """Yield GeoJSON features from the column store, one dict at a time."""
+    for row in zip(*(cols[field] for field in BAG_FIELDS), cols["geometry"]):
+        props = {field: val for field, val in zip(BAG_FIELDS, row) if val is not None}
+        yield {"type": "Feature", "properties": props, "geometry": row[-1]}
+
+
+def write_geojson(path, metadata, features, compress=False):
+    """Write FeatureCollection with orjson, in chunks to cap peak memory.
+
+    With compress=True a path + ".gz" copy is written in the same pass.
+    """
+    features = iter(features)
+    with open(path, "wb") as fh, \
+            (gzip.open(path + ".gz", "wb", compresslevel=6) if compress else nullcontext()) as gz:
+        def write(data):
+            fh.write(data)
+            if gz is not None:
+                gz.write(data)
+
+        write(b'{"type":"FeatureCollection","metadata":')
+        write(orjson.dumps(metadata))
+        write(b',"features":[')
+        first = True
+        while True:
+            chunk = list(islice(features, WRITE_CHUNK))
+            if not chunk:
+                break
+            if not first:
+                write(b",")
+            first = False
+            # [1:-1] strips de list-haken van de chunk
+            write(orjson.dumps(chunk)[1:-1])
+        write(b"]}")
+
+
+def build_gemeente(gemeente_code, gemeente_naam, bbox, output_dir=None, compress=False):
     """Build BAG GeoJSON for a single gemeente."""
     output_dir = output_dir or OUTPUT_DIR
     os.makedirs(output_dir, exist_ok=True)
@@ -193,80 +288,64 @@ def build_gemeente(gemeente_code, gemeente_naam, bbox, output_dir=None):
         log.warning(f"  Geen features gevonden voor {gemeente_naam}")
         return None
 
-    # 2. Download all pages
-    log.info("Stap 2: Downloaden...")
-    all_features = []
+    # 2. Download all pages; elke pagina gaat direct opgeschoond en
+    # ontdubbeld de kolomopslag in, zodat ruwe pagina's niet blijven hangen
+    log.info("Stap 2: Downloaden + opschonen...")
+    cols = new_columns()
+    seen = set()
+    raw_count = 0
     total_pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
     t0 = time.time()
 
-    for page in range(total_pages):
-        start_index = page * PAGE_SIZE
-        pct = f" ({len(all_features)}/{total})" if total > 0 else ""
-        log.info(f"  Page {page+1}/{total_pages}{pct}...")
+    # Eén pagina vooruit: de volgende download loopt terwijl deze pagina
+    # wordt opgeschoond. Tempo en aantal gelijktijdige requests bewaakt
+    # pdok_get, over alle gemeenten heen
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetch:
+        next_page = prefetch.submit(download_page, bbox, 0)
+        for page in range(total_pages):
+            pct = f" ({raw_count}/{total})" if total > 0 else ""
+            log.info(f"  Page {page+1}/{total_pages}{pct}...")
 
-        features = download_page(bbox, start_index)
-        all_features.extend(features)
+            features = next_page.result()
+            if features and page + 1 < total_pages:
+                next_page = prefetch.submit(download_page, bbox, (page + 1) * PAGE_SIZE)
 
-        if not features:
-            break
+            raw_count += len(features)
+            append_page(cols, seen, features)
 
-        # Rate limiting — kleine pauze om PDOK niet te overbelasten
-        if page > 0 and page % 10 == 0:
-            time.sleep(1)
+            if not features:
+                break
 
     elapsed = time.time() - t0
-    log.info(f"  {len(all_features)} features in {elapsed:.1f}s")
+    count = len(seen)
+    log.info(f"  {raw_count} features in {elapsed:.1f}s")
+    log.info(f"  {count} unieke adressen (van {raw_count} raw)")
 
-    # 3. Clean
-    log.info("Stap 3: Opschonen...")
-    cleaned = []
-    for f in all_features:
-        c = clean_feature(f)
-        if c:
-            cleaned.append(c)
-
-    # Deduplicate by identificatie
-    seen = set()
-    unique = []
-    for f in cleaned:
-        fid = f["properties"].get("identificatie")
-        if fid and fid not in seen:
-            seen.add(fid)
-            unique.append(f)
-
-    log.info(f"  {len(unique)} unieke adressen (van {len(all_features)} raw)")
-
-    # Statistieken
-    gebruiksdoelen = {}
-    statussen = {}
-    for f in unique:
-        gd = f["properties"].get("gebruiksdoel", "onbekend")
-        st = f["properties"].get("status", "onbekend")
-        gebruiksdoelen[gd] = gebruiksdoelen.get(gd, 0) + 1
-        statussen[st] = statussen.get(st, 0) + 1
+    # 3. Statistieken (tellen over de kolommen)
+    log.info("Stap 3: Statistieken...")
+    gebruiksdoelen = dict(Counter("onbekend" if v is None else v for v in cols["gebruiksdoel"]))
+    statussen = dict(Counter("onbekend" if v is None else v for v in cols["status"]))
 
     # 4. Write
     log.info("Stap 4: Schrijven...")
-    geojson = {
-        "type": "FeatureCollection",
-        "metadata": {
-            "gemeentecode": gemeente_code,
-            "gemeentenaam": gemeente_naam,
-            "count": len(unique),
-            "generated": time.strftime("%Y-%m-%dT%H:%M:%S"),
-            "source": "PDOK BAG WFS",
-            "gebruiksdoelen": gebruiksdoelen,
-            "statussen": statussen,
-        },
-        "features": unique,
+    metadata = {
+        "gemeentecode": gemeente_code,
+        "gemeentenaam": gemeente_naam,
+        "count": count,
+        "generated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "source": "PDOK BAG WFS",
+        "gebruiksdoelen": gebruiksdoelen,
+        "statussen": statussen,
     }
-
-    with open(output_path, "w", encoding="utf-8") as fh:
-        json.dump(geojson, fh, ensure_ascii=False, separators=(",", ":"))
+    write_geojson(output_path, metadata, iter_features(cols), compress)
 
     size_mb = os.path.getsize(output_path) / (1024 * 1024)
     log.info(f"  {output_path}: {size_mb:.1f} MB")
-    log.info(f"  Geschat gzipped: ~{size_mb * 0.25:.1f} MB")
+    if compress:
+        gz_path = output_path + ".gz"
+        log.info(f"  {gz_path}: {os.path.getsize(gz_path) / (1024 * 1024):.1f} MB")
+    else:
+        log.info(f"  Geschat gzipped: ~{size_mb * 0.25:.1f} MB")
     log.info(f"  Gebruiksdoelen: {gebruiksdoelen}")
     log.info("  KLAAR!")
     return output_path
@@ -295,6 +374,10 @@ def main():
                         help="Bestand met gemeentecodes (1 per regel)")
     parser.add_argument("--output", type=str, default=None,
                         help="Output directory (default: ./bag/)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help=f"Aantal gemeenten tegelijk (default: {WORKERS})")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Schrijf naast elk .geojson ook een .geojson.gz")
     args = parser.parse_args()
 
     # Load gemeente data
@@ -357,6 +440,15 @@ def main():
         print("  python build_bag.py --all                        # Alle gemeenten")
         sys.exit(0)
 
+    # Ontdubbelen op code (ook code + naam van dezelfde gemeente): anders
+    # schrijven twee threads tegelijk hetzelfde bag_<code>.geojson
+    unique = {}
+    for target in targets:
+        unique.setdefault(target[0], target)
+    if len(unique) < len(targets):
+        log.info(f"  {len(targets) - len(unique)} dubbele gemeente(n) overgeslagen")
+        targets = list(unique.values())
+
     if not targets:
         log.error("Geen gemeenten geselecteerd")
         sys.exit(1)
@@ -368,15 +460,24 @@ def main():
     log.info(f"  Output: {output_dir}")
     log.info(f"{'='*50}")
 
+    # Gemeenten parallel; elke gemeente pagineert zelf sequentieel (PDOK throttling)
     results = []
-    for i, (code, naam, bbox) in enumerate(targets):
-        log.info(f"\n[{i+1}/{len(targets)}] {naam} ({code})")
-        try:
-            path = build_gemeente(code, naam, bbox, output_dir)
-            if path:
-                results.append((code, naam, path))
-        except Exception as e:
-            log.error(f"  FOUT bij {naam}: {e}")
+    order = {code: i for i, (code, _, _) in enumerate(targets)}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        futures = {
+            executor.submit(build_gemeente, code, naam, bbox, output_dir, args.gzip): (code, naam)
+            for code, naam, bbox in targets
+        }
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            code, naam = futures[future]
+            try:
+                path = future.result()
+                if path:
+                    results.append((code, naam, path))
+                log.info(f"[{done}/{len(targets)}] {naam} ({code}) afgerond")
+            except Exception as e:
+                log.error(f"  FOUT bij {naam}: {e}")
+    results.sort(key=lambda r: order[r[0]])
 
     # Samenvatting
     log.info("\n" + "=" * 50)
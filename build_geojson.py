@@ -9,6 +9,11 @@ Usage:
     python build_geojson.py --type gemeenten --year 2022
     python build_geojson.py --type buurten --year 2024
     python build_geojson.py --type gemeenten --all-years
+    python build_geojson.py --type buurten --year 2024 --no-cache   # Opnieuw downloaden
+    python build_geojson.py --type buurten --year 2024 --gzip       # Ook .geojson.gz
+    python build_geojson.py --type buurten --year 2024 --ndjson     # Ook .geojsonl.gz
+    python build_geojson.py --type buurten --year 2024 --topojson   # Ook .topo.json.gz
+    python build_geojson.py --type buurten --year 2024 --no-property-filter  # Geen propertyName
 
 Beschikbare jaren op PDOK: 2012, 2017, 2018, 2019, 2022, 2023, 2024
 Let op: laagnamen veranderen per era:
@@ -16,20 +21,34 @@ Let op: laagnamen veranderen per era:
   - 2022-2024: buurten, wijken, gemeenten
 
 Dependencies:
-    pip install requests shapely
+    pip install requests "shapely>=2.0" "orjson>=3.9"
 """
 
 import argparse
-import json
+import concurrent.futures
+import functools
+import gzip
+import hashlib
 import logging
+import math
+import multiprocessing
 import os
-import re
+import sqlite3
 import sys
 import time
+from collections import deque
+from contextlib import nullcontext
+from itertools import islice
+from operator import itemgetter
 
+import orjson
 import requests
-from shapely.geometry import shape, mapping
-from shapely.validation import make_valid
+import shapely
+import shapely.errors
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from geojsonl import ndjson_path, write_ndjson
 
 # ---------------------------------------------------------------------------
 # Configuration
@@ -37,6 +56,35 @@ from shapely.validation import make_valid
 
 PDOK_WFS = "https://service.pdok.nl/cbs/wijkenbuurten/{year}/wfs/v1_0"
 PAGE_SIZE = 1000  # PDOK max per request
+MISSING = -99990  # CBS-waarden hieronder betekenen 'geen data'
+HITS_MARKER = b'numberMatched="'  # Attribuut met de telling in een hits-response
+DOWNLOAD_WORKERS = 8  # Pagina's tegelijk in de lucht
+PREFETCH_PAGES = 2 * DOWNLOAD_WORKERS  # Max pagina's vooruit (download + buffer)
+SIMPLIFY_BATCH = 1000  # Geometrieën per gevectoriseerde Shapely-aanroep
+SIMPLIFY_WORKERS = os.cpu_count() or 1  # Processen voor simplificatie
+WRITE_CHUNK = 2000  # Features per orjson.dumps bij het schrijven
+SMALL_GEOM_VERTICES = 20  # Kleinere geometrieën alleen afronden, niet via GEOS
+FAST_SIMPLIFY_VERTICES = 1000  # Vanaf hier simplify zonder preserve_topology
+MIN_COORD_PRECISION = 4  # Nooit minder dan 4 decimalen (~10 m)
+
+# Lokale cache van ruwe WFS features, zodat een rebuild (bijv. andere
+# tolerantie) niet opnieuw alles van PDOK haalt
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+CACHE_MAX_AGE = 7 * 24 * 3600  # seconden
+FIELDS_MAX_AGE = 30 * 24 * 3600  # Schema's wijzigen zelden
+PROBE_PAGE_SIZE = 100  # Features per propertyName-probe
+FILTER_MIN_SAVING = 0.9  # propertyName alleen als de pagina < 90% van ongefilterd is
+
+# Gedeelde sessie: keep-alive over alle pagina's, retry bij tijdelijke fouten.
+# pool_block: meer gelijktijdige requests dan pool_maxsize wachten op een vrije
+# verbinding i.p.v. een extra (na afloop weggegooide) TLS-verbinding te openen.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS, pool_block=True,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+))
+# Geen "br": requests pakt brotli alleen uit als het brotli-pakket er is
+SESSION.headers.update({"Accept-Encoding": "gzip, deflate", "User-Agent": "geoinzicht-build/1.0"})
 
 AVAILABLE_YEARS = [2012, 2017, 2018, 2019, 2022, 2023, 2024]
 
@@ -179,16 +227,47 @@ def get_layer_name(feat_type, year):
             return f"cbs_{feat_type}_{year}"
 
 
-def discover_fields(base_url, type_name):
+_available_fields = {}  # (base_url, type_name) -> property names, per proces
+
+
+def discover_fields(base_url, type_name, use_cache=True):
+    """Available property names of a layer.
+
+    Served from memory or the disk cache (FIELDS_MAX_AGE) when possible; with
+    use_cache=False always fetched, and the caches are refreshed.
+    """
+    key = (base_url, type_name)
+    digest = hashlib.blake2b("|".join(key).encode("utf-8"), digest_size=8).hexdigest()
+    path = os.path.join(CACHE_DIR, f"avail_{digest}.json")
+    if use_cache:
+        if key in _available_fields:
+            return list(_available_fields[key])
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < FIELDS_MAX_AGE:
+            with open(path, "rb") as fh:
+                _available_fields[key] = orjson.loads(fh.read())
+            return list(_available_fields[key])
+
+    fields = fetch_field_names(base_url, type_name)
+    if fields:
+        _available_fields[key] = fields
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(orjson.dumps(fields))
+        os.replace(tmp_path, path)
+    return list(fields)
+
+
+def fetch_field_names(base_url, type_name):
     """Fetch 1 feature to discover available property names."""
     params = {
         "service": "WFS", "version": "2.0.0", "request": "GetFeature",
         "typeNames": type_name, "outputFormat": "application/json",
         "count": 1, "srsName": "EPSG:4326",
     }
-    resp = requests.get(base_url, params=params, timeout=30)
+    resp = SESSION.get(base_url, params=params, timeout=30)
     resp.raise_for_status()
-    data = resp.json()
+    data = orjson.loads(resp.content)
     if data.get("features"):
         return list(data["features"][0]["properties"].keys())
     return []
@@ -196,11 +275,23 @@ def discover_fields(base_url, type_name):
 
 def resolve_fields(available):
     """Match app field keys to actual PDOK property names."""
-    avail_lower = {f.lower(): f for f in available}
+    # Jaren/lagen met hetzelfde schema delen het resultaat; kopie zodat
+    # aanroepers de gecachte mapping niet kunnen wijzigen
+    return dict(_resolve_fields(tuple(available)))
+
+
+@functools.lru_cache(maxsize=None)
+def _resolve_fields(available):
+    """resolve_fields on a tuple (order matters: it decides fuzzy-match ties)."""
+    avail_set = set(available)
+    # Eén keer lowercasen; lijst i.p.v. dict zodat de fuzzy match dezelfde
+    # volgorde (en dus dezelfde winnaar) houdt als `available`
+    avail_pairs = [(f.lower(), f) for f in available]
+    avail_lower = dict(avail_pairs)
     resolved = {}
     for app_key, pdok_names in PDOK_FIELDS.items():
         for pdok_name in pdok_names:
-            if pdok_name in available:
+            if pdok_name in avail_set:
                 resolved[app_key] = pdok_name
                 break
             elif pdok_name.lower() in avail_lower:
@@ -209,8 +300,9 @@ def resolve_fields(available):
         else:
             # Fuzzy match: zoek of het ergens in zit
             for pdok_name in pdok_names:
-                for af in available:
-                    if pdok_name.lower() in af.lower():
+                pdok_low = pdok_name.lower()
+                for af_low, af in avail_pairs:
+                    if pdok_low in af_low:
                         resolved[app_key] = af
                         break
                 if app_key in resolved:
@@ -224,55 +316,220 @@ def count_total(base_url, type_name):
         "service": "WFS", "version": "2.0.0", "request": "GetFeature",
         "typeNames": type_name, "resultType": "hits",
     }
-    resp = requests.get(base_url, params=params, timeout=30)
-    resp.raise_for_status()
-    m = re.search(r'numberMatched="(\d+)"', resp.text)
-    return int(m.group(1)) if m else -1
+    with SESSION.get(base_url, params=params, timeout=30, stream=True) as resp:
+        resp.raise_for_status()
+        # numberMatched is een attribuut van het root-element: de eerste
+        # paar KB volstaan, de rest van de response hoeft niet gelezen
+        head = resp.raw.read(4096, decode_content=True)
+        if HITS_MARKER not in head:
+            head += resp.raw.read(decode_content=True)
+    i = head.find(HITS_MARKER)
+    if i < 0:
+        return -1
+    i += len(HITS_MARKER)
+    try:
+        return int(head[i:head.find(b'"', i)])
+    except ValueError:  # bijv. numberMatched="unknown"
+        return -1
 
 
-def download_features(base_url, type_name, prop_names, expected_total=-1):
-    """Download all features from PDOK WFS with pagination."""
-    all_features = []
-    start = 0
+def page_params(type_name, prop_str, start, count=PAGE_SIZE):
+    """GetFeature parameters for one page; prop_str=None requests all properties."""
+    params = {
+        "service": "WFS", "version": "2.0.0", "request": "GetFeature",
+        "typeNames": type_name, "outputFormat": "application/json",
+        "srsName": "EPSG:4326", "count": count, "startIndex": start,
+    }
+    if prop_str:
+        params["propertyName"] = prop_str
+    return params
+
+
+def property_filter_pays_off(base_url, type_name, prop_names, use_cache=True):
+    """Whether propertyName makes pages at least FILTER_MIN_SAVING smaller.
+
+    Some GeoServer layers take a slower projection path for propertyName; if
+    it barely saves bytes it is not worth it. Probed once with a small page
+    with and without the filter; the decision is cached like the schema.
+    """
     prop_str = ",".join(prop_names + ["geom"])
+    digest = hashlib.blake2b(f"{base_url}|{type_name}|{prop_str}".encode("utf-8"), digest_size=8).hexdigest()
+    path = os.path.join(CACHE_DIR, f"propfilter_{digest}.json")
+    if use_cache and os.path.exists(path) and time.time() - os.path.getmtime(path) < FIELDS_MAX_AGE:
+        with open(path, "rb") as fh:
+            return orjson.loads(fh.read())
+
+    sizes = []
+    for probe in (prop_str, None):
+        resp = SESSION.get(base_url, params=page_params(type_name, probe, 0, PROBE_PAGE_SIZE), timeout=120)
+        resp.raise_for_status()
+        sizes.append(len(resp.content))
+    pays_off = sizes[0] < FILTER_MIN_SAVING * sizes[1]
+    log.info(f"  propertyName-probe: {sizes[0]} vs {sizes[1]} bytes -> "
+             f"{'filteren' if pays_off else 'alle properties'}")
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(orjson.dumps(pays_off))
+    os.replace(tmp_path, path)
+    return pays_off
+
+
+def fetch_page(base_url, type_name, prop_str, start):
+    """Download one page of features starting at startIndex=start."""
+    params = page_params(type_name, prop_str, start)
+    resp = SESSION.get(base_url, params=params, timeout=600)
+    resp.raise_for_status()
+    if start == 0:
+        log.info(f"  Content-Encoding: {resp.headers.get('Content-Encoding', 'geen')}")
+    return orjson.loads(resp.content)
+
+
+def iter_features(base_url, type_name, prop_names, expected_total=-1, property_filter=True):
+    """Yield all features from PDOK WFS, page by page in startIndex order.
+
+    With a known total all pages are fetched concurrently in the background;
+    each page is yielded (and can be released) as soon as it is its turn.
+    With property_filter=False all properties are requested (no propertyName).
+    """
+    prop_str = ",".join(prop_names + ["geom"]) if property_filter else None
+    if expected_total <= 0:
+        yield from iter_features_sequential(base_url, type_name, prop_str)
+        return
+
+    starts = range(0, expected_total, PAGE_SIZE)
+    todo = iter(starts)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        # Begrensde wachtrij: hooguit PREFETCH_PAGES pagina's downloaden of
+        # wachten op verwerking, zodat geheugen niet meegroeit met de laag
+        pending = deque(
+            (start, executor.submit(fetch_page, base_url, type_name, prop_str, start))
+            for start in islice(todo, PREFETCH_PAGES)
+        )
+        n = 0
+        while pending:
+            start, future = pending.popleft()
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.append((nxt, executor.submit(fetch_page, base_url, type_name, prop_str, nxt)))
+            last = future.result().get("features", [])
+            n += 1
+            log.info(f"  PDOK page {n}/{len(starts)} (startIndex={start})")
+            yield from last
+
+    # Telling kan achterlopen: doorgaan zolang de laatste pagina vol was
+    start = starts[-1] + PAGE_SIZE
+    while len(last) == PAGE_SIZE:
+        last = fetch_page(base_url, type_name, prop_str, start).get("features", [])
+        yield from last
+        start += PAGE_SIZE
+
+
+def field_map_cache_path(feat_type, year):
+    """Cache file for the resolved field map of one (year, type).
+
+    The name includes a hash of PDOK_FIELDS, so editing the mapping
+    invalidates old entries.
+    """
+    spec = hashlib.blake2b(orjson.dumps(PDOK_FIELDS), digest_size=4).hexdigest()
+    return os.path.join(CACHE_DIR, f"fields_{year}_{feat_type}_{spec}.json")
+
+
+def cache_path(base_url, type_name, prop_names):
+    """Cache file for one WFS query (URL incl. year, layer, property set)."""
+    key = "|".join([base_url, type_name] + sorted(prop_names))
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+    return os.path.join(CACHE_DIR, f"{digest}.jsonl.gz")
+
+
+def iter_features_cached(base_url, type_name, prop_names, expected_total=-1, use_cache=True,
+                         property_filter=True):
+    """Like iter_features, but served from / written to a gzipped JSONL cache.
+
+    With use_cache=False the cache is not read, but it is refreshed. Whether
+    propertyName is sent is only probed when there really is a download.
+    """
+    path = cache_path(base_url, type_name, prop_names)
+    if use_cache and os.path.exists(path) and time.time() - os.path.getmtime(path) < CACHE_MAX_AGE:
+        log.info(f"  Uit cache: {path}")
+        with gzip.open(path, "rb") as fh:
+            for line in fh:
+                yield orjson.loads(line)
+        return
+
+    if property_filter:
+        property_filter = property_filter_pays_off(base_url, type_name, prop_names, use_cache)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wb", compresslevel=3) as fh:
+        for feature in iter_features(base_url, type_name, prop_names, expected_total, property_filter):
+            fh.write(orjson.dumps(feature, option=orjson.OPT_APPEND_NEWLINE))
+            yield feature
+    # Pas na een volledige download de cache vervangen
+    os.replace(tmp_path, path)
+
+
+def iter_features_sequential(base_url, type_name, prop_str):
+    """Yield page by page (total unknown) until PDOK returns a short page."""
+    count = 0
+    start = 0
 
     while True:
-        params = {
-            "service": "WFS", "version": "2.0.0", "request": "GetFeature",
-            "typeNames": type_name, "outputFormat": "application/json",
-            "srsName": "EPSG:4326", "count": PAGE_SIZE, "startIndex": start,
-            "propertyName": prop_str,
-        }
-
-        pct = f" ({len(all_features)}/{expected_total})" if expected_total > 0 else f" ({len(all_features)})"
-        log.info(f"  PDOK page startIndex={start}{pct}...")
-        resp = requests.get(base_url, params=params, timeout=600)
-        resp.raise_for_status()
-        data = resp.json()
+        log.info(f"  PDOK page startIndex={start} ({count})...")
+        data = fetch_page(base_url, type_name, prop_str, start)
         features = data.get("features", [])
-        all_features.extend(features)
+        count += len(features)
+        yield from features
         if len(features) == 0:
             break
-        nm = data.get("numberMatched", expected_total)
-        if nm > 0 and len(all_features) >= nm:
+        nm = data.get("numberMatched", -1)
+        if nm > 0 and count >= nm:
             break
         if len(features) < PAGE_SIZE:
             break
         start += len(features)
 
-    return all_features
-
 
 def clean_value(val):
     """Convert CBS/PDOK missing-data markers to None."""
     if val is None:
         return None
     if isinstance(val, (int, float)):
-        if val <= -99990:
+        if val <= MISSING:
             return None
     return val
 
 
+def values_getter(keys):
+    """Return a function that fetches the values for keys from a dict in one call.
+
+    Uses operator.itemgetter (one C call for all keys); falls back to
+    dict.get per key when a key is missing.
+    """
+    keys = tuple(keys)
+    if len(keys) < 2:
+        return lambda d: tuple(d.get(k) for k in keys)
+    getter = itemgetter(*keys)
+
+    def get(d):
+        try:
+            return getter(d)
+        except KeyError:
+            return tuple(d.get(k) for k in keys)
+    return get
+
+
+def coord_precision(tolerance):
+    """Decimals worth keeping: one more than the simplification tolerance resolves.
+
+    0.0003 and 0.0005 give 5 decimals, 0.001 gives 4; digits below that are
+    noise next to the simplification error.
+    """
+    if tolerance <= 0:
+        return 5
+    return max(MIN_COORD_PRECISION, math.ceil(-math.log10(tolerance)) + 1)
+
+
 def round_coords(coords, precision=5):
     """Recursively round coordinates to save space."""
     if isinstance(coords, (list, tuple)):
@@ -282,25 +539,382 @@ def round_coords(coords, precision=5):
     return coords
 
 
+def round_ring(ring, precision=5):
+    """Round one ring of [x, y] pairs (2D, as PDOK delivers) in a flat loop."""
+    return [[round(p[0], precision), round(p[1], precision)] for p in ring]
+
+
+def round_geometry(geom_dict, precision=5):
+    """Round a GeoJSON geometry in place; (Multi)Polygons recurse per ring only."""
+    coords = geom_dict["coordinates"]
+    geom_type = geom_dict.get("type")
+    if geom_type == "Polygon":
+        geom_dict["coordinates"] = [round_ring(r, precision) for r in coords]
+    elif geom_type == "MultiPolygon":
+        geom_dict["coordinates"] = [[round_ring(r, precision) for r in poly] for poly in coords]
+    else:
+        geom_dict["coordinates"] = round_coords(coords, precision)
+    return geom_dict
+
+
 def simplify_geometry(geom_dict, tolerance):
-    """Simplify GeoJSON geometry using Shapely."""
+    """Simplify one GeoJSON geometry (fallback when a whole batch fails).
+
+    Same steps as simplify_geometries_geos, but isolated per feature so one
+    bad geometry cannot take the rest of the batch down with it.
+    """
+    precision = coord_precision(tolerance)
     try:
-        geom = shape(geom_dict)
-        if not geom.is_valid:
-            geom = make_valid(geom)
-        simplified = geom.simplify(tolerance, preserve_topology=True)
-        if simplified.is_empty:
+        geom = shapely.from_geojson(orjson.dumps(geom_dict))
+        # Geldigheid pas op het (veel kleinere) resultaat controleren; alleen
+        # bij een ongeldig resultaat of GEOS-fout het origineel repareren
+        try:
+            simplified = shapely.simplify(geom, tolerance, preserve_topology=True)
+        except shapely.errors.GEOSException:
+            simplified = None
+        if simplified is None or not shapely.is_valid(simplified):
+            simplified = shapely.simplify(shapely.make_valid(geom), tolerance, preserve_topology=True)
+        simplified = shapely.set_precision(simplified, 10 ** -precision)
+        if shapely.is_empty(simplified):
             return geom_dict
-        result = mapping(simplified)
-        result["coordinates"] = round_coords(result["coordinates"], 5)
-        return result
+        result = orjson.loads(shapely.to_geojson(simplified))
+        if "coordinates" in result:
+            return round_geometry(result, precision)
     except Exception as e:
         log.warning(f"Simplificatie mislukt: {e}")
-        geom_dict["coordinates"] = round_coords(geom_dict["coordinates"], 5)
-        return geom_dict
+    return round_geometry(geom_dict, precision)
+
+
+def vertex_count(geom_dict):
+    """Number of coordinate pairs in a (Multi)Polygon GeoJSON geometry."""
+    coords = geom_dict.get("coordinates") or []
+    if geom_dict.get("type") == "MultiPolygon":
+        return sum(len(ring) for poly in coords for ring in poly)
+    if geom_dict.get("type") == "Polygon":
+        return sum(len(ring) for ring in coords)
+    return SMALL_GEOM_VERTICES  # Onbekend type: altijd via GEOS
+
+
+def simplify_geometries(geom_dicts, tolerance):
+    """Simplify a batch of GeoJSON geometries.
+
+    Geometries with fewer than SMALL_GEOM_VERTICES points have nothing to
+    simplify and are only rounded; the rest go through GEOS in one batch.
+    """
+    precision = coord_precision(tolerance)
+    results = [None] * len(geom_dicts)
+    large = []
+    for i, geom_dict in enumerate(geom_dicts):
+        if vertex_count(geom_dict) < SMALL_GEOM_VERTICES:
+            results[i] = round_geometry(geom_dict, precision)
+        else:
+            large.append(i)
+    if large:
+        simplified = simplify_geometries_geos([geom_dicts[i] for i in large], tolerance)
+        for i, geom in zip(large, simplified):
+            results[i] = geom
+    return results
+
+
+def simplify_geometries_geos(geom_dicts, tolerance):
+    """Simplify a batch of GeoJSON geometries with Shapely 2.0's vectorized functions.
+
+    Like simplify_geometry per feature, but valid-check, make_valid, simplify
+    and grid snapping each run as one GEOS loop over the whole batch.
+    """
+    precision = coord_precision(tolerance)
+    try:
+        geoms = shapely.from_geojson([orjson.dumps(g) for g in geom_dicts])
+        # Grote geometrieën: gewone Douglas-Peucker (zonder topologie-bewaking)
+        # is veel sneller; een ongeldig resultaat wordt hieronder toch hersteld
+        large = shapely.get_num_coordinates(geoms) >= FAST_SIMPLIFY_VERTICES
+        simplified = geoms.copy()
+        simplified[~large] = shapely.simplify(geoms[~large], tolerance, preserve_topology=True)
+        simplified[large] = shapely.simplify(geoms[large], tolerance, preserve_topology=False)
+        # Geldigheid op het vereenvoudigde resultaat (minder punten) controleren;
+        # alleen de ongeldige opnieuw, met make_valid op het origineel
+        invalid = ~shapely.is_valid(simplified)
+        if invalid.any():
+            simplified[invalid] = shapely.simplify(
+                shapely.make_valid(geoms[invalid]), tolerance, preserve_topology=True)
+        # Op het raster van de output-decimalen snappen: punten die daarbij
+        # samenvallen verdwijnen en ringen blijven geldig
+        simplified = shapely.set_precision(simplified, 10 ** -precision)
+        empty = shapely.is_empty(simplified)
+        geojson_strs = shapely.to_geojson(simplified)
+    except Exception as e:
+        log.warning(f"Batch-simplificatie mislukt, per feature verder: {e}")
+        return [simplify_geometry(g, tolerance) for g in geom_dicts]
+
+    results = []
+    for geom_dict, is_empty, geojson_str in zip(geom_dicts, empty, geojson_strs):
+        if is_empty:
+            results.append(geom_dict)
+            continue
+        # orjson + afronden per ring is ~1.7x sneller dan json met parse_float-hook
+        result = orjson.loads(geojson_str)
+        if "coordinates" not in result:
+            # GeometryCollection uit make_valid: zelfde fallback als simplify_geometry
+            result = geom_dict
+        results.append(round_geometry(result, precision))
+    return results
+
+
+def simplify_geometries_json(geom_dicts, tolerance):
+    """simplify_geometries, serialized in the worker: a list of orjson bytes.
+
+    Bytes pickle back to the main process far cheaper than nested coordinate
+    lists, and go into the cache and the output file without re-encoding.
+    """
+    return [orjson.dumps(g) for g in simplify_geometries(geom_dicts, tolerance)]
+
+
+def submit_simplify(pool, batch, keys, tolerance):
+    """Submit the geometries of a list of features as one batch.
+
+    Returns (batch, keys, future) for collect_simplified.
+    """
+    geoms = [f["geometry"] for f in batch]
+    return batch, keys, pool.submit(simplify_geometries_json, geoms, tolerance)
+
+
+def open_geom_cache():
+    """Open (or create) the SQLite cache of simplified geometries."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    conn = sqlite3.connect(os.path.join(CACHE_DIR, "geom.sqlite"))
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS g (key BLOB PRIMARY KEY, geom BLOB)")
+    return conn
+
+
+def geom_cache_key(geom_dict, tolerance):
+    """Content hash of a raw geometry plus every setting that affects its output."""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{tolerance}|{coord_precision(tolerance)}|{SMALL_GEOM_VERTICES}|{FAST_SIMPLIFY_VERTICES}|".encode("ascii"))
+    h.update(orjson.dumps(geom_dict))
+    return h.digest()
+
+
+def collect_simplified(batches, geom_cache, wait=True):
+    """Put simplified geometries back in their features and store them in the cache.
+
+    Batches are taken from the front of the deque. With wait=False only the
+    batches that are already done are collected, so their raw geometries
+    can be released while the download is still running.
+    """
+    while batches and (wait or batches[0][2].done()):
+        batch, keys, future = batches.popleft()
+        rows = []
+        for f, key, blob in zip(batch, keys, future.result()):
+            # Fragment: orjson schrijft de bytes ongewijzigd in de output
+            f["geometry"] = orjson.Fragment(blob)
+            rows.append((key, blob))
+        geom_cache.executemany("INSERT OR REPLACE INTO g (key, geom) VALUES (?, ?)", rows)
+    geom_cache.commit()
+
+
+def write_geojson(path, metadata, features, compress=False):
+    """Write FeatureCollection with orjson, in chunks to cap peak memory.
+
+    With compress=True a path + ".gz" copy is written in the same pass.
+    """
+    with open(path, "wb") as fh, \
+            (gzip.open(path + ".gz", "wb", compresslevel=6) if compress else nullcontext()) as gz:
+        def write(data):
+            fh.write(data)
+            if gz is not None:
+                gz.write(data)
+
+        write(b'{"type":"FeatureCollection","metadata":')
+        write(orjson.dumps(metadata))
+        write(b',"features":[')
+        for i in range(0, len(features), WRITE_CHUNK):
+            if i:
+                write(b",")
+            # [1:-1] strips de list-haken van de chunk
+            write(orjson.dumps(features[i:i + WRITE_CHUNK])[1:-1])
+        write(b"]}")
+
+
+def topojson_path(path):
+    """Sidecar name for the TopoJSON copy: buurten_2024.topo.json.gz."""
+    return os.path.splitext(path)[0] + ".topo.json.gz"
+
+
+def _iter_rings(geom):
+    """All rings of a (Multi)Polygon geometry dict."""
+    geom_type = geom.get("type") if geom else None
+    if geom_type == "Polygon":
+        yield from geom["coordinates"]
+    elif geom_type == "MultiPolygon":
+        for poly in geom["coordinates"]:
+            yield from poly
+
+
+def _topo_ring(ring, x0, y0, grid):
+    """Ring as closed list of integer grid points (x, y); None if degenerate."""
+    pts = []
+    last = None
+    for p in ring:
+        q = (round((p[0] - x0) / grid), round((p[1] - y0) / grid))
+        if q != last:
+            pts.append(q)
+            last = q
+    if pts and pts[0] != pts[-1]:
+        pts.append(pts[0])
+    return pts if len(pts) >= 4 else None
+
+
+def _topo_polygons(geom, x0, y0, grid):
+    """(Multi)Polygon as a list of polygons, each a list of quantized rings."""
+    geom_type = geom.get("type") if geom else None
+    if geom_type == "Polygon":
+        polys = [geom["coordinates"]]
+    elif geom_type == "MultiPolygon":
+        polys = geom["coordinates"]
+    else:
+        return []
+    result = []
+    for poly in polys:
+        rings = [_topo_ring(r, x0, y0, grid) for r in poly]
+        # Zonder buitenring vervalt de polygoon; gedegenereerde gaten vervallen
+        if rings and rings[0] is not None:
+            result.append([r for r in rings if r is not None])
+    return result
+
+
+def _topo_junctions(rings):
+    """Points where rings meet or part ways: their neighbours differ per ring.
+
+    A point on a border shared by two rings has the same two neighbours in
+    both (in opposite order); at the ends of that border they differ.
+    """
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        n = len(ring) - 1
+        for i in range(n):
+            a, b = ring[i - 1] if i else ring[n - 1], ring[i + 1]
+            pair = (a, b) if a < b else (b, a)
+            p = ring[i]
+            seen = neighbours.setdefault(p, pair)
+            if seen != pair:
+                junctions.add(p)
+    return junctions
+
+
+def _topo_cut(ring, junctions):
+    """Split a closed ring at its junctions into arcs (lists of points).
+
+    A ring without junctions is one arc, rotated to start at its smallest
+    point so the same ring from another feature (either direction) matches.
+    """
+    n = len(ring) - 1
+    starts = [i for i in range(n) if ring[i] in junctions]
+    if not starts:
+        k = min(range(n), key=ring.__getitem__)
+        return [ring[k:n] + ring[:k + 1]]
+    k = starts[0]
+    rotated = ring[k:n] + ring[:k + 1]
+    arcs = []
+    current = [rotated[0]]
+    for p in rotated[1:]:
+        current.append(p)
+        if p in junctions:
+            arcs.append(current)
+            current = [p]
+    return arcs
+
+
+def write_topojson(path, object_name, metadata, features, raw_geoms, tolerance, precision=5):
+    """Write a gzipped, quantized TopoJSON copy of the (Multi)Polygon features.
+
+    Built from the raw (un-simplified) geometries in raw_geoms, aligned with
+    features: rings are quantized to 10**-precision, cut at the junctions
+    where neighbouring areas meet, and every border shared by two buurten
+    is stored once as an arc. The arcs are simplified afterwards, so both
+    neighbours keep exactly the same border. Arcs are delta-encoded.
+    """
+    grid = 10 ** -precision
+    x0 = y0 = math.inf
+    for g in raw_geoms:
+        for ring in _iter_rings(g):
+            for p in ring:
+                if p[0] < x0:
+                    x0 = p[0]
+                if p[1] < y0:
+                    y0 = p[1]
+    if x0 == math.inf:
+        x0 = y0 = 0.0
+
+    polygons = [_topo_polygons(g, x0, y0, grid) for g in raw_geoms]
+    junctions = _topo_junctions(r for polys in polygons for poly in polys for r in poly)
+
+    # Arcs ontdubbelen: dezelfde rand in omgekeerde richting wordt ~index
+    arcs = []
+    arc_index = {}
+
+    def arc_id(points):
+        key = tuple(points)
+        i = arc_index.get(key)
+        if i is not None:
+            return i
+        i = arc_index.get(key[::-1])
+        if i is not None:
+            return ~i
+        arc_index[key] = len(arcs)
+        arcs.append(points)
+        return len(arcs) - 1
+
+    ring_arcs = [[[[arc_id(a) for a in _topo_cut(r, junctions)] for r in poly] for poly in polys]
+                 for polys in polygons]
+    del arc_index, polygons, junctions
+
+    # Simplificatie per arc (eindpunten blijven staan, dus gedeelde randen
+    # blijven gedeeld); een ring die daardoor degenereert houdt zijn ruwe arcs
+    lines = shapely.linestrings([p for a in arcs for p in a],
+                                indices=[i for i, a in enumerate(arcs) for _ in a]) if arcs else []
+    simplified = [shapely.get_coordinates(line).astype(int).tolist()
+                  for line in shapely.simplify(lines, tolerance / grid, preserve_topology=False)]
+    keep_raw = set()
+    for polys in ring_arcs:
+        for poly in polys:
+            for ids in poly:
+                if 1 + sum(len(simplified[~i if i < 0 else i]) - 1 for i in ids) < 4:
+                    keep_raw.update(~i if i < 0 else i for i in ids)
+
+    encoded = []
+    for i, (raw, simple) in enumerate(zip(arcs, simplified)):
+        points = raw if i in keep_raw else simple
+        delta = []
+        px = py = 0
+        for x, y in points:
+            delta.append([x - px, y - py])
+            px, py = x, y
+        encoded.append(delta)
+    del arcs, simplified
+
+    geometries = []
+    for f, polys in zip(features, ring_arcs):
+        if not polys:
+            geometries.append({"type": None, "properties": f["properties"]})
+        elif len(polys) == 1:
+            geometries.append({"type": "Polygon", "arcs": polys[0], "properties": f["properties"]})
+        else:
+            geometries.append({"type": "MultiPolygon", "arcs": polys, "properties": f["properties"]})
+    topology = {
+        "type": "Topology",
+        "metadata": metadata,
+        "transform": {"scale": [grid, grid], "translate": [x0, y0]},
+        "objects": {object_name: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": encoded,
+    }
+    with gzip.open(path, "wb", compresslevel=6) as fh:
+        fh.write(orjson.dumps(topology))
 
 
-def build_year(feat_type, year, tolerance, output=None):
+def build_year(feat_type, year, tolerance, output=None, use_cache=True, compress=False, ndjson=False,
+               property_filter=True, topojson=False):
     """Build GeoJSON for a specific type and year."""
     output = output or f"{feat_type}_{year}.geojson"
     base_url = PDOK_WFS.format(year=year)
@@ -310,21 +924,34 @@ def build_year(feat_type, year, tolerance, output=None):
 
     log.info("=" * 50)
     log.info(f"  {feat_type.upper()} {year}")
-    log.info(f"  Laag: {type_name}  Tolerantie: {tolerance}")
+    log.info(f"  Laag: {type_name}  Tolerantie: {tolerance}  Decimalen: {coord_precision(tolerance)}")
     log.info("=" * 50)
 
-    # 1. Discover fields
-    log.info(f"Stap 1: PDOK velden ontdekken ({type_name})...")
-    try:
-        available = discover_fields(base_url, type_name)
-    except Exception as e:
-        log.error(f"  FOUT: {e}")
-        log.error(f"  Jaar {year} bestaat mogelijk niet voor {feat_type}")
-        return None
-    log.info(f"  {len(available)} velden beschikbaar")
+    # 1+2. Discover fields and resolve mapping (of uit de cache)
+    fields_path = field_map_cache_path(feat_type, year)
+    # Zelfde houdbaarheid als de schema-cache: PDOK kan velden hernoemen
+    if use_cache and os.path.exists(fields_path) and time.time() - os.path.getmtime(fields_path) < FIELDS_MAX_AGE:
+        log.info(f"Stap 1: PDOK velden uit cache ({fields_path})")
+        with open(fields_path, "rb") as fh:
+            field_map = orjson.loads(fh.read())
+    else:
+        log.info(f"Stap 1: PDOK velden ontdekken ({type_name})...")
+        try:
+            available = discover_fields(base_url, type_name, use_cache)
+        except Exception as e:
+            log.error(f"  FOUT: {e}")
+            log.error(f"  Jaar {year} bestaat mogelijk niet voor {feat_type}")
+            return None
+        log.info(f"  {len(available)} velden beschikbaar")
+
+        field_map = resolve_fields(available)
+        if field_map:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = fields_path + ".tmp"
+            with open(tmp_path, "wb") as fh:
+                fh.write(orjson.dumps(field_map))
+            os.replace(tmp_path, fields_path)
 
-    # 2. Resolve mapping
-    field_map = resolve_fields(available)
     found_count = len(field_map)
     total_count = len(PDOK_FIELDS)
     log.info(f"Stap 2: {found_count}/{total_count} indicatoren gevonden")
@@ -337,59 +964,110 @@ def build_year(feat_type, year, tolerance, output=None):
     total = count_total(base_url, type_name)
     log.info(f"  {total} {feat_type} verwacht")
 
-    request_props = list(set(admin_fields + list(field_map.values())))
+    # Volgorde-behoudend ontdubbelen: dezelfde run geeft dezelfde propertyName-URL
+    request_props = list(dict.fromkeys(admin_fields + list(field_map.values())))
+    # 4. Download, clean, simplify and compact in één doorloop: elke pagina
+    # wordt verwerkt zodra hij binnen is, er is geen lijst met ruwe features.
+    # Simplificatie gaat in batches naar een procespool (spawn: de download-
+    # threads lopen al, fork met actieve threads is niet veilig).
     log.info(f"  Downloaden ({len(request_props)} properties)...")
+    log.info(f"Stap 4: Opschonen (tolerantie={tolerance}, {SIMPLIFY_WORKERS} processen)...")
     t0 = time.time()
-    raw = download_features(base_url, type_name, request_props, total)
-    log.info(f"  {len(raw)} features in {time.time()-t0:.1f}s")
-
-    # 4. Clean, simplify and compact
-    log.info(f"Stap 4: Opschonen (tolerantie={tolerance})...")
-    features = []
+    # Ontdubbelen tijdens het inlezen: per ID de feature met de meeste
+    # properties; een duplicaat dat verliest wordt niet eens gesimplificeerd
+    best = {}
+    # Voor --topojson: ruwe geometrie per ID (de arcs worden pas na het
+    # vinden van gedeelde randen vereenvoudigd)
+    raw_geoms = {} if topojson else None
+    kept_count = 0
     indicators_with_data = set()
-
-    for i, f in enumerate(raw):
-        props = f.get("properties", {})
-        geom = f.get("geometry")
-        if not props.get(id_field) or not geom:
-            continue
-
-        clean = {}
-        for af in admin_fields:
-            if props.get(af) is not None:
-                clean[af] = props[af]
-
-        for app_key, pdok_field in field_map.items():
-            v = clean_value(props.get(pdok_field))
-            if v is not None:
-                if isinstance(v, float):
+    raw_count = 0
+    batches = deque()
+    app_keys = tuple(field_map)
+    get_pdok_values = values_getter(field_map.values())
+    # Vereenvoudigde geometrieën uit eerdere builds (zelfde ruwe geometrie en
+    # instellingen) komen uit de cache; alleen de rest gaat naar de pool
+    geom_cache = open_geom_cache()
+    cache_hits = 0
+    pending, pending_keys = [], []
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=SIMPLIFY_WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for i, f in enumerate(iter_features_cached(base_url, type_name, request_props, total, use_cache,
+                                                       property_filter)):
+            raw_count += 1
+            props = f.get("properties", {})
+            props_get = props.get
+            geom = f.get("geometry")
+            if not props_get(id_field) or not geom:
+                continue
+
+            clean = {}
+            for af in admin_fields:
+                v = props_get(af)
+                if v is not None:
+                    clean[af] = v
+
+            # Zelfde regels als clean_value, inline om een call per veld te sparen;
+            # type() is: één vergelijking i.p.v. een isinstance-call
+            for app_key, v in zip(app_keys, get_pdok_values(props)):
+                if v is None:
+                    continue
+                t = type(v)
+                if t is float:
+                    if v <= MISSING:
+                        continue
                     v = round(v, 2)
+                elif t is int and v <= MISSING:
+                    continue
                 clean[app_key] = v
                 indicators_with_data.add(app_key)
 
-        geom = simplify_geometry(geom, tolerance)
-
-        features.append({
-            "type": "Feature",
-            "properties": clean,
-            "geometry": geom,
-        })
-
-        if (i + 1) % 3000 == 0:
-            log.info(f"  {i+1}/{len(raw)} verwerkt...")
+            kept_count += 1
+            fid = props[id_field]
+            prev = best.get(fid)
+            if prev is not None and len(clean) <= len(prev["properties"]):
+                continue
+            feature = {
+                "type": "Feature",
+                "properties": clean,
+                "geometry": geom,
+            }
+            best[fid] = feature
+            if topojson:
+                raw_geoms[fid] = geom
+
+            key = geom_cache_key(geom, tolerance)
+            row = geom_cache.execute("SELECT geom FROM g WHERE key = ?", (key,)).fetchone() if use_cache else None
+            if row:
+                feature["geometry"] = orjson.Fragment(row[0])
+                cache_hits += 1
+            else:
+                pending.append(feature)
+                pending_keys.append(key)
+                if len(pending) >= SIMPLIFY_BATCH:
+                    batches.append(submit_simplify(pool, pending, pending_keys, tolerance))
+                    pending, pending_keys = [], []
+                    # Klaar? Dan ruwe geometrieën nu al vervangen (geheugen)
+                    collect_simplified(batches, geom_cache, wait=False)
+
+            if (i + 1) % 3000 == 0:
+                log.info(f"  {i+1}/{total} verwerkt...")
+
+        if pending:
+            batches.append(submit_simplify(pool, pending, pending_keys, tolerance))
+        log.info(f"  {raw_count} features in {time.time()-t0:.1f}s, simplificatie afronden...")
+
+        collect_simplified(batches, geom_cache)
+    geom_cache.close()
+    log.info(f"  Simplificatie klaar na {time.time()-t0:.1f}s ({cache_hits} uit cache)")
 
-    # Dedupliceer: houd per ID de feature met de meeste properties
-    before_dedup = len(features)
-    best = {}
-    for f in features:
-        fid = f["properties"].get(id_field, "")
-        if not fid:
-            continue
-        if fid not in best or len(f["properties"]) > len(best[fid]["properties"]):
-            best[fid] = f
     features = list(best.values())
-    if len(features) < before_dedup:
-        log.info(f"  Deduplicatie: {before_dedup} → {len(features)} ({before_dedup - len(features)} duplicaten verwijderd)")
+    if topojson:
+        raw_geoms = [raw_geoms[fid] for fid in best]
+    del best
+    if len(features) < kept_count:
+        log.info(f"  Deduplicatie: {kept_count} → {len(features)} ({kept_count - len(features)} duplicaten verwijderd)")
 
     # Count features with actual CBS data (more than just admin fields)
     admin_count = len(admin_fields)
@@ -399,26 +1077,33 @@ def build_year(feat_type, year, tolerance, output=None):
 
     # 5. Write
     log.info("Stap 5: Schrijven...")
-    geojson = {
-        "type": "FeatureCollection",
-        "metadata": {
-            "type": feat_type,
-            "year": year,
-            "generated": time.strftime("%Y-%m-%dT%H:%M:%S"),
-            "count": len(features),
-            "with_data": with_data,
-            "indicators": sorted(indicators_with_data),
-            "indicators_count": len(indicators_with_data),
-        },
-        "features": features,
+    metadata = {
+        "type": feat_type,
+        "year": year,
+        "generated": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "count": len(features),
+        "with_data": with_data,
+        "indicators": sorted(indicators_with_data),
+        "indicators_count": len(indicators_with_data),
+        "coord_precision": coord_precision(tolerance),
     }
-
-    with open(output, "w", encoding="utf-8") as fh:
-        json.dump(geojson, fh, ensure_ascii=False, separators=(",", ":"))
+    write_geojson(output, metadata, features, compress)
+    if ndjson:
+        write_ndjson(ndjson_path(output), metadata, features)
+    if topojson:
+        write_topojson(topojson_path(output), feat_type, metadata, features, raw_geoms, tolerance,
+                       metadata["coord_precision"])
 
     size_mb = os.path.getsize(output) / (1024 * 1024)
     log.info(f"  {output}: {size_mb:.1f} MB")
-    log.info(f"  Geschat gzipped: ~{size_mb * 0.25:.1f} MB")
+    if compress:
+        log.info(f"  {output}.gz: {os.path.getsize(output + '.gz') / (1024 * 1024):.1f} MB")
+    if ndjson:
+        log.info(f"  {ndjson_path(output)}: {os.path.getsize(ndjson_path(output)) / (1024 * 1024):.1f} MB")
+    if topojson:
+        log.info(f"  {topojson_path(output)}: {os.path.getsize(topojson_path(output)) / (1024 * 1024):.1f} MB")
+    else:
+        log.info(f"  Geschat gzipped: ~{size_mb * 0.25:.1f} MB")
     log.info("  KLAAR!")
     return output
 
@@ -433,6 +1118,16 @@ def main():
     parser.add_argument("--tolerance", type=float, default=None,
                         help="Simplificatie-tolerantie in graden.")
     parser.add_argument("--output", type=str, default=None)
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Negeer de lokale WFS-cache (.cache/) en download opnieuw")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Schrijf in dezelfde pass ook een .geojson.gz")
+    parser.add_argument("--topojson", action="store_true",
+                        help="Schrijf ook een .topo.json.gz (gedeelde randen één keer, gekwantiseerd)")
+    parser.add_argument("--no-property-filter", action="store_true",
+                        help="Vraag alle properties op (geen propertyName, geen probe)")
+    parser.add_argument("--ndjson", action="store_true",
+                        help="Schrijf ook een .geojsonl.gz (één feature per regel, voor streamend laden)")
     args = parser.parse_args()
 
     # Defaults per type
@@ -443,14 +1138,18 @@ def main():
         log.info(f"Alle jaren bouwen voor {args.type}: {AVAILABLE_YEARS}")
         for year in AVAILABLE_YEARS:
             try:
-                build_year(args.type, year, args.tolerance)
+                build_year(args.type, year, args.tolerance,
+                           use_cache=not args.no_cache, compress=args.gzip, ndjson=args.ndjson,
+                           property_filter=not args.no_property_filter, topojson=args.topojson)
             except Exception as e:
                 log.error(f"Fout bij {args.type} {year}: {e}")
         log.info("=" * 50)
         log.info("  ALLE JAREN KLAAR!")
         log.info("=" * 50)
     else:
-        build_year(args.type, args.year, args.tolerance, args.output)
+        build_year(args.type, args.year, args.tolerance, args.output,
+                   use_cache=not args.no_cache, compress=args.gzip, ndjson=args.ndjson,
+                   property_filter=not args.no_property_filter, topojson=args.topojson)
 
 
 if __name__ == "__main__":
@@ -21,6 +21,9 @@ Gebruik:
     # Bounding box (xmin,ymin,xmax,ymax in WGS84)
     python download_bag.py --bbox 4.85,52.35,4.95,52.40 --type panden
 
+    # Ook een gzip-kopie (.geojson.gz) schrijven
+    python download_bag.py --gemeente Amsterdam --type panden --gzip
+
     # Hele Nederland (LET OP: ~10 miljoen panden, duurt uren!)
     python download_bag.py --type panden --heel-nederland
 
@@ -29,17 +32,27 @@ Alternatief voor heel Nederland:
     https://service.pdok.nl/kadaster/bag/atom/downloads/bag-light.gpkg
 
 Dependencies:
-    pip install requests
+    pip install requests orjson
 """
 
 import argparse
-import json
+import concurrent.futures
+import functools
+import gzip
 import logging
 import os
+import re
 import sys
+import threading
 import time
+from collections import deque
+from contextlib import nullcontext
+from itertools import count as count_from, islice
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ---------------------------------------------------------------------------
 # Configuration
@@ -47,6 +60,27 @@ import requests
 
 PDOK_BAG_WFS = "https://service.pdok.nl/lv/bag/wfs/v2_0"
 PAGE_SIZE = 1000  # PDOK hard limit
+DOWNLOAD_WORKERS = 8  # Pagina's tegelijk in de lucht
+REQUEST_INTERVAL = 0.5  # Min. seconden tussen twee request-starts (~2 req/s)
+
+# Lokale cache (zelfde map als build_geojson); bbox per gemeente
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+BBOX_CACHE = os.path.join(CACHE_DIR, "bbox.json")
+
+# Gedeelde sessie voor WFS én Locatieserver: keep-alive, gecomprimeerde
+# responses, en 429/5xx worden met backoff herhaald
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS, pool_block=True,
+    max_retries=Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504]),
+))
+# Geen "br": requests pakt brotli alleen uit als het brotli-pakket er is
+SESSION.headers.update({"Accept-Encoding": "gzip, deflate", "User-Agent": "geoinzicht-build/1.0"})
+
+# Voorgecompileerd: telling in een hits-response (bytes) en WKT-centroide
+_NUMBER_MATCHED_RE = re.compile(rb'numberMatched="(\d+)"')
+_POINT_RE = re.compile(r'POINT\(([^ ]+) ([^ ]+)\)')
 
 # Velden per type
 PAND_FIELDS = [
@@ -76,7 +110,6 @@ def count_features(type_name, cql_filter=None):
     """Tel features. NB: PDOK BAG WFS negeert CQL_FILTER bij resultType=hits,
     dus de count is alleen betrouwbaar zonder CQL filter.
     Met CQL filter retourneren we -1 (onbekend)."""
-    import re
     if cql_filter:
         return -1  # Count niet betrouwbaar met CQL op BAG WFS
     params = {
@@ -84,18 +117,66 @@ def count_features(type_name, cql_filter=None):
         "typeNames": type_name, "resultType": "hits",
     }
     try:
-        resp = requests.get(PDOK_BAG_WFS, params=params, timeout=30)
+        resp = SESSION.get(PDOK_BAG_WFS, params=params, timeout=30)
         resp.raise_for_status()
-        m = re.search(r'numberMatched="(\d+)"', resp.text)
+        m = _NUMBER_MATCHED_RE.search(resp.content)
         return int(m.group(1)) if m else -1
     except Exception:
         return -1
 
 
-def download_features(type_name, fields, cql_filter=None, bbox=None, max_features=None):
-    """Download alle features met paginatie."""
-    all_features = []
-    start = 0
+_rate_lock = threading.Lock()
+_next_request = 0.0
+
+
+def wait_for_rate_limit():
+    """Token bucket over alle threads: hooguit één request per REQUEST_INTERVAL."""
+    global _next_request
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_request - now
+        _next_request = max(now, _next_request) + REQUEST_INTERVAL
+    if wait > 0:
+        time.sleep(wait)
+
+
+def fetch_page(type_name, prop_str, cql_filter, start):
+    """Haal één pagina op; geeft de lijst features terug."""
+    params = {
+        "service": "WFS", "version": "2.0.0", "request": "GetFeature",
+        "typeNames": type_name, "outputFormat": "application/json",
+        "srsName": "EPSG:4326", "count": PAGE_SIZE, "startIndex": start,
+        "sortBy": "identificatie",
+        "propertyName": prop_str,
+    }
+    if cql_filter:
+        params["CQL_FILTER"] = cql_filter
+
+    while True:
+        wait_for_rate_limit()
+        try:
+            resp = SESSION.get(PDOK_BAG_WFS, params=params, timeout=120)
+            resp.raise_for_status()
+            if start == 0:
+                log.info(f"  Content-Encoding: {resp.headers.get('Content-Encoding', 'geen')}")
+            return orjson.loads(resp.content).get("features", [])
+        # orjson's decodefout is geen RequestException (resp.json()'s wel):
+        # een afgekapte of verminkte pagina moet net zo goed opnieuw
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError) as e:
+            log.error(f"  Request fout (startIndex={start}): {e}")
+            if start == 0:
+                raise
+            log.info("  Opnieuw proberen na 5 seconden...")
+            time.sleep(5)
+
+
+def iter_features(type_name, fields, cql_filter=None, bbox=None, max_features=None):
+    """Download alle features met paginatie; levert ze per pagina op (generator).
+
+    Pagina's worden parallel opgehaald (DOWNLOAD_WORKERS tegelijk, met
+    rate limit) en in startIndex-volgorde doorgegeven. Er staan nooit meer
+    dan DOWNLOAD_WORKERS pagina's in het geheugen.
+    """
     prop_str = ",".join(fields)
 
     # PDOK BAG WFS: BBOX parameter werkt niet, maar CQL_FILTER BBOX() wel
@@ -105,48 +186,39 @@ def download_features(type_name, fields, cql_filter=None, bbox=None, max_feature
     elif bbox:
         cql_filter = f"BBOX(geom,{bbox},'EPSG:4326')"
 
-    while True:
-        params = {
-            "service": "WFS", "version": "2.0.0", "request": "GetFeature",
-            "typeNames": type_name, "outputFormat": "application/json",
-            "srsName": "EPSG:4326", "count": PAGE_SIZE, "startIndex": start,
-            "sortBy": "identificatie",
-            "propertyName": prop_str,
-        }
-        if cql_filter:
-            params["CQL_FILTER"] = cql_filter
-
-        log.info(f"  Page startIndex={start} ({len(all_features)} features tot nu toe)...")
-
-        try:
-            resp = requests.get(PDOK_BAG_WFS, params=params, timeout=120)
-            resp.raise_for_status()
-            data = resp.json()
-        except requests.exceptions.RequestException as e:
-            log.error(f"  Request fout: {e}")
-            if start > 0:
-                log.info("  Opnieuw proberen na 5 seconden...")
-                time.sleep(5)
-                continue
-            raise
-
-        features = data.get("features", [])
-        all_features.extend(features)
-
-        if len(features) == 0:
-            break
-        if max_features and len(all_features) >= max_features:
-            all_features = all_features[:max_features]
-            break
-        if len(features) < PAGE_SIZE:
-            break
-
-        start += len(features)
-
-        # Rate limiting: 0.5s pauze tussen requests
-        time.sleep(0.5)
-
-    return all_features
+    # Met bekend totaal liggen alle offsets vast; anders speculatief vooruit
+    # halen tot een korte pagina het einde aangeeft
+    limit = count_features(type_name, cql_filter)
+    if max_features and (limit < 0 or max_features < limit):
+        limit = max_features
+    starts = count_from(0, PAGE_SIZE) if limit < 0 else iter(range(0, limit, PAGE_SIZE))
+
+    count = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        pending = deque(
+            (start, executor.submit(fetch_page, type_name, prop_str, cql_filter, start))
+            for start in islice(starts, DOWNLOAD_WORKERS)
+        )
+        while pending:
+            start, future = pending.popleft()
+            features = future.result()
+            log.info(f"  Page startIndex={start} ({count + len(features)} features tot nu toe)...")
+
+            if max_features and count + len(features) >= max_features:
+                yield from features[:max_features - count]
+                break
+            count += len(features)
+            yield from features
+
+            if len(features) < PAGE_SIZE:
+                break
+            nxt = next(starts, None)
+            if nxt is not None:
+                pending.append((nxt, executor.submit(fetch_page, type_name, prop_str, cql_filter, nxt)))
+
+        # Overbodige vooruit-aanvragen na het einde niet meer starten
+        for _, future in pending:
+            future.cancel()
 
 
 def build_cql_filter(gemeente=None, postcode=None, woonplaats=None, status_filter=True):
@@ -184,20 +256,47 @@ def build_pand_cql(gemeente=None, bbox_filter=None, status_filter=True):
     return " AND ".join(parts) if parts else None
 
 
+@functools.lru_cache(maxsize=None)
+def load_bbox_cache():
+    """Bbox-cache van schijf ({genormaliseerde naam: bbox}); één keer per proces."""
+    try:
+        with open(BBOX_CACHE, "rb") as fh:
+            return orjson.loads(fh.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+
+
 def get_gemeente_bbox(gemeente_naam):
+    """Bounding box voor een gemeente; uit de cache of via Locatieserver."""
+    key = gemeente_naam.strip().lower()
+    cache = load_bbox_cache()
+    if key in cache:
+        return cache[key]
+
+    bbox = lookup_gemeente_bbox(gemeente_naam)
+    if bbox:
+        # Alleen gevonden bboxen bewaren; atomair vervangen
+        cache[key] = bbox
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = BBOX_CACHE + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(orjson.dumps(cache, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+        os.replace(tmp_path, BBOX_CACHE)
+    return bbox
+
+
+def lookup_gemeente_bbox(gemeente_naam):
     """Haal bounding box op voor een gemeente via PDOK Locatieserver."""
-    import re
-
     # PDOK Locatieserver centroide + ruime buffer
     try:
         url = f"https://api.pdok.nl/bzk/locatieserver/search/v3_1/free?q={gemeente_naam}&fq=type:gemeente&rows=1"
-        resp = requests.get(url, timeout=15)
+        resp = SESSION.get(url, timeout=15)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         if data.get("response", {}).get("docs"):
             doc = data["response"]["docs"][0]
             if "centroide_ll" in doc:
-                m = re.search(r'POINT\(([^ ]+) ([^ ]+)\)', doc["centroide_ll"])
+                m = _POINT_RE.search(doc["centroide_ll"])
                 if m:
                     lng, lat = float(m.group(1)), float(m.group(2))
                     # Buffer afhankelijk van stad (grote steden groter)
@@ -209,13 +308,13 @@ def get_gemeente_bbox(gemeente_naam):
     # Fallback: probeer als woonplaats
     try:
         url = f"https://api.pdok.nl/bzk/locatieserver/search/v3_1/free?q={gemeente_naam}&fq=type:woonplaats&rows=1"
-        resp = requests.get(url, timeout=15)
+        resp = SESSION.get(url, timeout=15)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         if data.get("response", {}).get("docs"):
             doc = data["response"]["docs"][0]
             if "centroide_ll" in doc:
-                m = re.search(r'POINT\(([^ ]+) ([^ ]+)\)', doc["centroide_ll"])
+                m = _POINT_RE.search(doc["centroide_ll"])
                 if m:
                     lng, lat = float(m.group(1)), float(m.group(2))
                     buf = 0.12
@@ -225,18 +324,50 @@ def get_gemeente_bbox(gemeente_naam):
     return None
 
 
-def save_geojson(features, output_path, type_name, metadata=None):
-    """Schrijf features als GeoJSON bestand."""
-    geojson = {
-        "type": "FeatureCollection",
-        "metadata": metadata or {},
-        "features": features,
-    }
-    with open(output_path, "w", encoding="utf-8") as fh:
-        json.dump(geojson, fh, ensure_ascii=False, separators=(",", ":"))
+def save_geojson(features, output_path, type_name, metadata=None, compress=False):
+    """Schrijf features (lijst of iterator) als GeoJSON bestand.
+
+    Features worden één voor één weggeschreven; metadata komt daarna, zodat
+    'count' het werkelijk geschreven aantal is. Met compress=True wordt in
+    dezelfde pass ook output_path + ".gz" geschreven. Geeft (size_mb, count) terug.
+
+    Er wordt naar .tmp-bestanden geschreven die pas na de laatste feature
+    het bestaande bestand vervangen: mislukt de download (of Ctrl+C), dan
+    blijft de vorige output intact.
+    """
+    metadata = dict(metadata or {})
+    count = 0
+    tmp_path = output_path + ".tmp"
+    gz_tmp_path = output_path + ".gz.tmp"
+    try:
+        with open(tmp_path, "wb") as fh, \
+                (gzip.open(gz_tmp_path, "wb", compresslevel=6) if compress else nullcontext()) as gz:
+            def write(data):
+                fh.write(data)
+                if gz is not None:
+                    gz.write(data)
+
+            write(b'{"type":"FeatureCollection","features":[')
+            for feature in features:
+                if count:
+                    write(b",")
+                write(orjson.dumps(feature))
+                count += 1
+            metadata["count"] = metadata["total_downloaded"] = count
+            write(b'],"metadata":')
+            write(orjson.dumps(metadata))
+            write(b"}")
+    except BaseException:
+        for path in (tmp_path, gz_tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    os.replace(tmp_path, output_path)
+    if compress:
+        os.replace(gz_tmp_path, output_path + ".gz")
 
     size_mb = os.path.getsize(output_path) / (1024 * 1024)
-    return size_mb
+    return size_mb, count
 
 
 def main():
@@ -272,6 +403,8 @@ Voor heel Nederland: download de BAG GeoPackage (~7.2 GB):
                         help="Output directory (default: huidige map)")
     parser.add_argument("--heel-nederland", action="store_true",
                         help="Download alles (WAARSCHUWING: miljoenen features!)")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Schrijf in dezelfde pass ook een .geojson.gz")
     args = parser.parse_args()
 
     # Validatie
@@ -351,15 +484,6 @@ Voor heel Nederland: download de BAG GeoPackage (~7.2 GB):
             log.info("  Downloaden...")
             max_feat = args.max
 
-            # Download
-            t0 = time.time()
-            features = download_features(
-                type_name, fields, cql_filter,
-                bbox=use_bbox, max_features=max_feat
-            )
-            elapsed = time.time() - t0
-            log.info(f"  {len(features):,} features gedownload in {elapsed:.1f}s")
-
             # Output bestandsnaam
             safe_label = (gemeente or "nederland").lower().replace(" ", "_")
             if args.postcode:
@@ -369,23 +493,33 @@ Voor heel Nederland: download de BAG GeoPackage (~7.2 GB):
                 f"bag_{bag_type}_{safe_label}.geojson"
             )
 
-            # Metadata
+            # Metadata (count wordt tijdens het schrijven ingevuld)
             metadata = {
                 "type": bag_type,
                 "source": "PDOK BAG WFS v2.0",
                 "api": PDOK_BAG_WFS,
                 "filter": cql_filter,
                 "bbox": use_bbox,
-                "count": len(features),
-                "total_downloaded": len(features),
                 "generated": time.strftime("%Y-%m-%dT%H:%M:%S"),
                 "update_frequency": "dagelijks (BAG wordt dagelijks bijgewerkt door Kadaster)",
             }
             if gemeente:
                 metadata["gemeente"] = gemeente
 
-            size_mb = save_geojson(features, output_file, bag_type, metadata)
+            # Download en schrijf pagina voor pagina
+            t0 = time.time()
+            features = iter_features(
+                type_name, fields, cql_filter,
+                bbox=use_bbox, max_features=max_feat
+            )
+            size_mb, count = save_geojson(features, output_file, bag_type, metadata,
+                                         compress=args.gzip)
+            elapsed = time.time() - t0
+            log.info(f"  {count:,} features gedownload in {elapsed:.1f}s")
             log.info(f"  Opgeslagen: {output_file} ({size_mb:.1f} MB)")
+            if args.gzip:
+                gz_mb = os.path.getsize(output_file + ".gz") / (1024 * 1024)
+                log.info(f"  {output_file}.gz: {gz_mb:.1f} MB")
 
     log.info(f"\n{'='*60}")
     log.info("  KLAAR!")
@@ -234,9 +234,11 @@ def enrich_geojson(filename, counts, code_field):
     meta["bag_source"] = "PDOK BAG WFS"
     geojson["metadata"] = meta
 
-    # Save
-    with open(filename, "w", encoding="utf-8") as f:
+    # Save via a temp file + rename, so an interrupted write leaves the original intact
+    tmp_path = filename + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
         json.dump(geojson, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, filename)
 
     size_mb = os.path.getsize(filename) / (1024 * 1024)
     log.info("  %.1f MB - %d indicatoren toegevoegd", size_mb, len(indicators_added))
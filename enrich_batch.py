@@ -4,31 +4,39 @@ Splits properties into groups of 20 to avoid PDOK timeouts.
 
 Usage:
     python enrich_batch.py --type gemeenten --year 2024
+    python enrich_batch.py --type buurten --year 2024 --ndjson   # Ook .geojsonl.gz
+    python enrich_batch.py --type buurten --year 2024 --gzip     # Ook .geojson.gz
 """
 
 import argparse
-import json
+import concurrent.futures
 import logging
 import os
 import sys
+import threading
 import time
-import requests
+
+import orjson
 
 from build_geojson import (
     PDOK_WFS, PDOK_FIELDS, ADMIN_FIELDS, ID_FIELD, AVAILABLE_YEARS,
-    get_layer_name, discover_fields, resolve_fields, clean_value, count_total,
+    get_layer_name, discover_fields, resolve_fields, MISSING, count_total,
+    write_geojson, SESSION,
 )
+from geojsonl import ndjson_path, write_ndjson
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(message)s", datefmt="%H:%M:%S",
                     handlers=[logging.StreamHandler(sys.stdout)])
 log = logging.getLogger("enrich")
 
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
 BATCH_SIZE = 15  # properties per request (ex id_field)
+FETCH_WORKERS = 6  # batches tegelijk
 
 
-def fetch_batch(base_url, type_name, id_field, prop_names, expected_total):
-    """Fetch a batch of properties (no geometry) and return as dict keyed by id."""
-    result = {}
+def iter_batch(base_url, type_name, id_field, prop_names, expected_total):
+    """Fetch a batch of properties (no geometry), page by page; yields (id, properties)."""
+    n = 0
     start = 0
     props_str = ",".join([id_field] + prop_names)
 
@@ -39,33 +47,48 @@ def fetch_batch(base_url, type_name, id_field, prop_names, expected_total):
             "count": 2000, "startIndex": start,
             "propertyName": props_str,
         }
-        resp = requests.get(base_url, params=params, timeout=120)
+        # Gedeelde sessie uit build_geojson: keep-alive + retry over alle batches
+        resp = SESSION.get(base_url, params=params, timeout=120)
         resp.raise_for_status()
-        data = resp.json()
+        data = orjson.loads(resp.content)
         features = data.get("features", [])
+        nm = data.get("numberMatched", expected_total)
+        del data, resp
 
         for f in features:
             p = f.get("properties", {})
             fid = p.get(id_field, "")
             if fid:
-                result[fid] = p
+                n += 1
+                yield fid, p
 
         if len(features) == 0 or len(features) < 2000:
             break
-        nm = data.get("numberMatched", expected_total)
-        if nm > 0 and len(result) >= nm:
+        if nm > 0 and n >= nm:
             break
         start += len(features)
 
-    return result
 
+def merge_batch(all_stats, lock, base_url, type_name, id_field, prop_names, expected_total):
+    """Merge one batch into all_stats while its pages come in; returns the number of ids."""
+    n = 0
+    for fid, props in iter_batch(base_url, type_name, id_field, prop_names, expected_total):
+        with lock:
+            # Eén lookup; de eerste batch levert de dict zelf (geen kopie)
+            stats = all_stats.setdefault(fid, props)
+            if stats is not props:
+                stats.update(props)
+        n += 1
+    return n
 
-def enrich(feat_type, year):
-    filename = f"{feat_type}_{year}.geojson"
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+def enrich(feat_type, year, ndjson=False, compress=False):
+    # Absolute paden i.p.v. os.chdir: geen globale toestand bij import/threads
+    name = f"{feat_type}_{year}.geojson"
+    filename = os.path.join(APP_DIR, name)
 
     if not os.path.exists(filename):
-        log.error(f"{filename} niet gevonden!")
+        log.error(f"{name} niet gevonden!")
         return
 
     base_url = PDOK_WFS.format(year=year)
@@ -77,9 +100,9 @@ def enrich(feat_type, year):
     log.info("=" * 50)
 
     # 1. Load existing
-    log.info(f"Laden: {filename}...")
-    with open(filename, "r", encoding="utf-8") as fh:
-        geojson = json.load(fh)
+    log.info(f"Laden: {name}...")
+    with open(filename, "rb") as fh:
+        geojson = orjson.loads(fh.read())
     features = geojson.get("features", [])
     log.info(f"  {len(features)} features")
 
@@ -96,22 +119,26 @@ def enrich(feat_type, year):
     batches = [pdok_fields_list[i:i+BATCH_SIZE] for i in range(0, len(pdok_fields_list), BATCH_SIZE)]
     log.info(f"  {len(batches)} batches van max {BATCH_SIZE} properties")
 
-    # 4. Fetch all batches
+    # 4. Fetch all batches, tegelijk (elke batch vraagt andere properties op);
+    # elke pagina gaat meteen all_stats in, zonder tussenresultaat per batch
+    t0 = time.time()
     all_stats = {}  # {fid: {prop: val, ...}}
-    for bi, batch in enumerate(batches):
-        log.info(f"  Batch {bi+1}/{len(batches)}: {len(batch)} properties...")
-        t0 = time.time()
-        try:
-            batch_data = fetch_batch(base_url, type_name, id_field, batch, total)
-            t1 = time.time()
-            log.info(f"    {len(batch_data)} gebieden in {t1-t0:.1f}s")
-            for fid, props in batch_data.items():
-                if fid not in all_stats:
-                    all_stats[fid] = {}
-                all_stats[fid].update(props)
-        except Exception as e:
-            log.error(f"    FOUT: {e}")
-            continue
+    stats_lock = threading.Lock()
+    workers = max(1, min(len(batches), FETCH_WORKERS))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(merge_batch, all_stats, stats_lock,
+                            base_url, type_name, id_field, batch, total): bi
+            for bi, batch in enumerate(batches)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            bi = futures[future]
+            try:
+                n = future.result()
+                log.info(f"  Batch {bi+1}/{len(batches)}: {len(batches[bi])} properties, "
+                         f"{n} gebieden na {time.time()-t0:.1f}s")
+            except Exception as e:
+                log.error(f"  Batch {bi+1}/{len(batches)} FOUT: {e}")
 
     log.info(f"  Totaal: {len(all_stats)} gebieden met data")
 
@@ -122,27 +149,35 @@ def enrich(feat_type, year):
 
     # Reverse field_map: pdok_field -> app_key
     reverse_map = {v: k for k, v in field_map.items()}
+    merge_items = tuple(reverse_map.items())
 
+    # Vaste volgorde (die van field_map): de batches komen in willekeurige
+    # volgorde binnen, dus de volgorde binnen pdok_props ligt niet vast
     for f in features:
         props = f.get("properties", {})
-        fid = props.get(id_field, "")
-        if fid and fid in all_stats:
-            pdok_props = all_stats[fid]
-            for pdok_field, val in pdok_props.items():
-                app_key = reverse_map.get(pdok_field)
-                if app_key:
-                    v = clean_value(val)
-                    if v is not None:
-                        if isinstance(v, float):
-                            v = round(v, 2)
-                        props[app_key] = v
-                        indicators_with_data.add(app_key)
+        pdok_props = all_stats.get(props.get(id_field, ""))
+        if pdok_props:
+            pdok_get = pdok_props.get
+            # Zelfde regels als clean_value, inline (zoals in build_year)
+            for pdok_field, app_key in merge_items:
+                v = pdok_get(pdok_field)
+                if v is None:
+                    continue
+                t = type(v)
+                if t is float:
+                    if v <= MISSING:
+                        continue
+                    v = round(v, 2)
+                elif t is int and v <= MISSING:
+                    continue
+                props[app_key] = v
+                indicators_with_data.add(app_key)
             enriched += 1
 
     log.info(f"  {enriched}/{len(features)} verrijkt, {len(indicators_with_data)} indicatoren")
 
     # 6. Update metadata & save
-    geojson["metadata"] = {
+    metadata = {
         "type": feat_type, "year": year,
         "generated": time.strftime("%Y-%m-%dT%H:%M:%S"),
         "count": len(features), "with_data": enriched,
@@ -150,9 +185,20 @@ def enrich(feat_type, year):
         "indicators_count": len(indicators_with_data),
     }
 
-    log.info(f"Opslaan: {filename}...")
-    with open(filename, "w", encoding="utf-8") as fh:
-        json.dump(geojson, fh, ensure_ascii=False, separators=(",", ":"))
+    # Gechunkt wegschrijven naar een tijdelijk bestand en dan atomair
+    # vervangen: een afgebroken run laat het origineel heel
+    log.info(f"Opslaan: {name}...")
+    tmp_path = filename + ".tmp"
+    write_geojson(tmp_path, metadata, features, compress)
+    os.replace(tmp_path, filename)
+    if compress:
+        os.replace(tmp_path + ".gz", filename + ".gz")
+        log.info(f"  {name}.gz: {os.path.getsize(filename + '.gz') / (1024 * 1024):.1f} MB")
+    elif os.path.exists(filename + ".gz"):
+        log.warning(f"  {name}.gz is nu verouderd (gebruik --gzip)")
+    if ndjson:
+        write_ndjson(ndjson_path(filename), metadata, features)
+        log.info(f"  {os.path.basename(ndjson_path(filename))} geschreven")
 
     size_mb = os.path.getsize(filename) / (1024 * 1024)
     log.info(f"  {size_mb:.1f} MB - KLAAR!")
@@ -162,5 +208,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--type", choices=["buurten", "wijken", "gemeenten"], default="gemeenten")
     parser.add_argument("--year", type=int, default=2024)
+    parser.add_argument("--ndjson", action="store_true",
+                        help="Schrijf ook een .geojsonl.gz (één feature per regel)")
+    parser.add_argument("--gzip", action="store_true",
+                        help="Schrijf in dezelfde pass ook een .geojson.gz")
     args = parser.parse_args()
-    enrich(args.type, args.year)
+    enrich(args.type, args.year, args.ndjson, args.gzip)
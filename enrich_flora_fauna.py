@@ -18,20 +18,30 @@ Usage:
     python enrich_flora_fauna.py                              # All GeoJSON
     python enrich_flora_fauna.py --type gemeenten --year 2022
     python enrich_flora_fauna.py --resume                     # Resume from cache
+    python enrich_flora_fauna.py --ndjson                     # Also write .geojsonl.gz
 
 Dependencies:
-    pip install requests
+    pip install requests orjson
 """
 
 import argparse
-import json
+import bisect
+import concurrent.futures
+import functools
 import logging
 import os
 import re
+import sqlite3
 import sys
+import threading
 import time
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from geojsonl import ndjson_path, write_ndjson
 
 logging.basicConfig(
     level=logging.INFO,
@@ -54,12 +64,32 @@ CLASS_AVES = 212       # Birds
 CLASS_MAMMALIA = 359   # Mammals
 KINGDOM_PLANTAE = 6    # Plants
 
-# Rate limiting
-REQUEST_DELAY = 0.6  # seconds between API calls (be nice to GBIF)
+# Rate limiting: min. seconds between request starts, over all threads
+REQUEST_DELAY = 0.2  # ~5 req/s (be nice to GBIF)
 MAX_RETRIES = 3
-
-# Cache file for GBIF results (so we can resume)
-CACHE_FILE = "gbif_flora_cache.json"
+# Gemeenten fetched concurrently. Facet queries take one to a few seconds,
+# so ~10 must be in flight to keep the rate limiter's 5 req/s busy
+FETCH_WORKERS = 10
+
+# Shared session: keep-alive; 502/503/504 are retried with backoff
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=1, pool_maxsize=FETCH_WORKERS, pool_block=True,
+    max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[502, 503, 504]),
+))
+SESSION.headers.update({"Accept-Encoding": "gzip, deflate", "User-Agent": "geoinzicht-build/1.0"})
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Cache of GBIF results per gemeente (so we can resume); every result is
+# committed as soon as it is fetched
+CACHE_FILE = os.path.join(APP_DIR, "gbif_flora_cache.sqlite")
+LEGACY_CACHE_FILE = os.path.join(APP_DIR, "gbif_flora_cache.json")  # imported once if present
+
+# Per-request HTTP cache: every successful GBIF response is kept, so an
+# interrupted run loses nothing, not even a half-fetched gemeente
+HTTP_CACHE_FILE = os.path.join(APP_DIR, ".cache", "gbif_http.sqlite")
+HTTP_CACHE_MAX_AGE = 30 * 24 * 3600  # seconds
 
 NAME_FIELD = {
     "gemeenten": "gemeentenaam",
@@ -68,27 +98,80 @@ NAME_FIELD = {
 }
 
 
+# Common suffixes, e.g. "Bergen (NH.)", "Utrecht (gemeente)"; a trailing
+# "(gemeente)" after a province suffix is stripped as well
+_SUFFIX_RE = re.compile(r'(?:\s*\((?:gemeente|L\.|O\.|GR\.|NH\.)\))+\s*$')
+
+
+@functools.lru_cache(maxsize=4096)
 def normalize_naam(naam):
-    """Normalize gemeente naam for matching."""
+    """Normalize gemeente naam for matching (memoized: a file has few distinct names)."""
     if not naam:
         return ""
-    naam = naam.strip()
-    # Common normalizations
-    naam = re.sub(r'\s*\(gemeente\)\s*$', '', naam)
-    naam = re.sub(r'\s*\(L\.\)\s*$', '', naam)
-    naam = re.sub(r'\s*\(O\.\)\s*$', '', naam)
-    naam = re.sub(r'\s*\(GR\.\)\s*$', '', naam)
-    naam = re.sub(r'\s*\(NH\.\)\s*$', '', naam)
-    return naam.strip().lower()
+    return _SUFFIX_RE.sub('', naam.strip()).strip().lower()
+
+
+_rate_lock = threading.Lock()
+_next_request = 0.0
+
+
+def wait_for_rate_limit():
+    """Token bucket shared by all threads: at most one request per REQUEST_DELAY."""
+    global _next_request
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_request - now
+        _next_request = max(now, _next_request) + REQUEST_DELAY
+    if wait > 0:
+        time.sleep(wait)
+
+
+_http_cache = None
+_http_cache_lock = threading.Lock()
+http_cache_read = True  # False with --no-cache: fetch again, but still store
+
+
+def http_cache():
+    """Open (or create) the SQLite cache of GBIF responses, shared by all threads."""
+    global _http_cache
+    if _http_cache is None:
+        os.makedirs(os.path.dirname(HTTP_CACHE_FILE), exist_ok=True)
+        conn = sqlite3.connect(HTTP_CACHE_FILE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS r (key TEXT PRIMARY KEY, fetched REAL, body BLOB)")
+        _http_cache = conn
+    return _http_cache
+
+
+def http_cache_key(url, params):
+    """Request URL with the parameters in a fixed order."""
+    return url + "?" + "&".join(f"{k}={v}" for k, v in sorted((params or {}).items()))
 
 
 def gbif_get(url, params=None):
-    """Make a GET request to GBIF API with retry logic."""
+    """Make a GET request to GBIF API with retry logic (served from the HTTP cache if fresh)."""
+    key = http_cache_key(url, params)
+    if http_cache_read:
+        with _http_cache_lock:
+            row = http_cache().execute(
+                "SELECT body FROM r WHERE key = ? AND fetched > ?",
+                (key, time.time() - HTTP_CACHE_MAX_AGE),
+            ).fetchone()
+        if row:
+            return orjson.loads(row[0])
+
     for attempt in range(MAX_RETRIES):
+        wait_for_rate_limit()
         try:
-            resp = requests.get(url, params=params, timeout=30)
+            resp = SESSION.get(url, params=params, timeout=30)
             if resp.status_code == 200:
-                return resp.json()
+                data = orjson.loads(resp.content)
+                with _http_cache_lock:
+                    conn = http_cache()
+                    conn.execute("INSERT OR REPLACE INTO r (key, fetched, body) VALUES (?, ?, ?)",
+                                 (key, time.time(), resp.content))
+                    conn.commit()
+                return data
             elif resp.status_code == 503:
                 log.warning("  GBIF 503 (overbelast), wacht 10s...")
                 time.sleep(10)
@@ -107,7 +190,8 @@ def gbif_get(url, params=None):
 def fetch_gadm_mapping():
     """
     Fetch all GADM level-2 entries for the Netherlands.
-    Returns dict: {normalized_name: gadm_gid}
+    Returns (gid_by_norm, original_by_norm):
+    {normalized_name: gadm_gid} and {normalized_name: GADM name}
     """
     log.info("GBIF GADM mapping ophalen voor Nederland (level %d)...", GADM_LEVEL)
     url = f"{GBIF_API}/geocode/gadm/search"
@@ -115,31 +199,57 @@ def fetch_gadm_mapping():
 
     if not data or "results" not in data:
         log.error("Kan GADM mapping niet ophalen!")
-        return {}
+        return {}, {}
 
-    mapping = {}
+    gid_by_norm = {}
+    original_by_norm = {}  # original name, for the log
     for entry in data["results"]:
         name = entry.get("name", "")
         gid = entry.get("id", "")
         if name and gid:
             key = normalize_naam(name)
-            mapping[key] = gid
-            # Also store original name for debugging
-            mapping[key + "__original"] = name
+            gid_by_norm[key] = gid
+            original_by_norm[key] = name
 
-    log.info("  %d GADM gemeenten gevonden", len([k for k in mapping if not k.endswith("__original")]))
-    return mapping
+    log.info("  %d GADM gemeenten gevonden", len(gid_by_norm))
+    return gid_by_norm, original_by_norm
 
 
-def count_species(gadm_gid, class_key=None, kingdom_key=None):
+def fuzzy_gadm_match(norm, gid_by_norm, sorted_norms):
     """
-    Count unique species in a GADM area using GBIF faceted search.
-    Returns (species_count, observation_count).
+    Find the normalized GADM name that contains, or is contained in, norm.
+    Prefix matches come from the sorted name list; only if there is none are
+    all names scanned.
+    """
+    # GADM names starting with norm
+    i = bisect.bisect_left(sorted_norms, norm)
+    if i < len(sorted_norms) and sorted_norms[i].startswith(norm):
+        return sorted_norms[i]
+    # Longest GADM name that norm starts with
+    for end in range(len(norm) - 1, 0, -1):
+        if norm[:end] in gid_by_norm:
+            return norm[:end]
+    # Substring anywhere else
+    for gadm_norm in gid_by_norm:
+        if norm in gadm_norm or gadm_norm in norm:
+            return gadm_norm
+    return None
+
+
+def facet_key(field):
+    """GBIF returns facet fields as SPECIES_KEY; requests use speciesKey."""
+    return field.replace("_", "").lower()
+
+
+def search_facets(gadm_gid, facets=("speciesKey",), class_key=None, kingdom_key=None):
+    """
+    Faceted GBIF occurrence search in a GADM area (no records, only counts).
+    Returns (observation_count, {facet: {value: count}}), or None on failure.
     """
     params = {
         "gadmGid": gadm_gid,
         "limit": 0,
-        "facet": "speciesKey",
+        "facet": list(facets),
         "facetLimit": 100000,
     }
     if class_key:
@@ -150,61 +260,106 @@ def count_species(gadm_gid, class_key=None, kingdom_key=None):
     url = f"{GBIF_API}/occurrence/search"
     data = gbif_get(url, params)
     if not data:
-        return 0, 0
+        return None
+
+    counts = {}
+    for facet in data.get("facets", []):
+        counts[facet_key(facet.get("field", ""))] = {
+            c.get("name"): c.get("count", 0) for c in facet.get("counts", [])
+        }
+    return data.get("count", 0), counts
 
-    observations = data.get("count", 0)
-    facets = data.get("facets", [])
-    species = 0
-    if facets and len(facets) > 0:
-        species = len(facets[0].get("counts", []))
 
-    return species, observations
+def count_species(gadm_gid, class_key=None, kingdom_key=None):
+    """
+    Count unique species in a GADM area using GBIF faceted search.
+    Returns (species_count, observation_count).
+    """
+    found = search_facets(gadm_gid, class_key=class_key, kingdom_key=kingdom_key)
+    if not found:
+        return 0, 0
+    observations, counts = found
+    return len(counts.get("specieskey", {})), observations
 
 
 def fetch_gemeente_data(gadm_gid, gemeente_naam):
     """Fetch all flora/fauna indicators for a single gemeente."""
     result = {}
-
-    # 1. Total species + observations
-    time.sleep(REQUEST_DELAY)
-    soorten, waarnemingen = count_species(gadm_gid)
-    result["ff_totaal_soorten"] = soorten
-    result["ff_totaal_waarnemingen"] = waarnemingen
+    # Pacing is done by the shared rate limiter in gbif_get
+
+    # 1. Total species + observations. The class and kingdom facets come
+    # with it at no extra request: they tell which of the per-group species
+    # counts below can only be 0, so those requests are skipped
+    found = search_facets(gadm_gid, facets=("speciesKey", "classKey", "kingdomKey"))
+    if found:
+        waarnemingen, counts = found
+        classes = counts.get("classkey", {})
+        kingdoms = counts.get("kingdomkey", {})
+        result["ff_totaal_soorten"] = len(counts.get("specieskey", {}))
+        result["ff_totaal_waarnemingen"] = waarnemingen
+    else:
+        # Unknown: query every group
+        classes = kingdoms = None
+        result["ff_totaal_soorten"] = 0
+        result["ff_totaal_waarnemingen"] = 0
+
+    def present(facet_counts, key):
+        return facet_counts is None or facet_counts.get(str(key), 0) > 0
 
     # 2. Bird species
-    time.sleep(REQUEST_DELAY)
-    vogels, _ = count_species(gadm_gid, class_key=CLASS_AVES)
+    vogels = count_species(gadm_gid, class_key=CLASS_AVES)[0] if present(classes, CLASS_AVES) else 0
     result["ff_soorten_vogels"] = vogels
 
     # 3. Mammal species
-    time.sleep(REQUEST_DELAY)
-    zoogdieren, _ = count_species(gadm_gid, class_key=CLASS_MAMMALIA)
+    zoogdieren = count_species(gadm_gid, class_key=CLASS_MAMMALIA)[0] if present(classes, CLASS_MAMMALIA) else 0
     result["ff_soorten_zoogdieren"] = zoogdieren
 
     # 4. Plant species
-    time.sleep(REQUEST_DELAY)
-    planten, _ = count_species(gadm_gid, kingdom_key=KINGDOM_PLANTAE)
+    planten = count_species(gadm_gid, kingdom_key=KINGDOM_PLANTAE)[0] if present(kingdoms, KINGDOM_PLANTAE) else 0
     result["ff_soorten_planten"] = planten
 
     return result
 
 
+_cache_db = None
+
+
+def cache_db():
+    """Open (or create) the SQLite cache of GBIF results, importing the old JSON cache once."""
+    global _cache_db
+    if _cache_db is None:
+        conn = sqlite3.connect(CACHE_FILE)
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v BLOB)")
+        empty = conn.execute("SELECT 1 FROM kv LIMIT 1").fetchone() is None
+        if empty and os.path.exists(LEGACY_CACHE_FILE):
+            with open(LEGACY_CACHE_FILE, "rb") as f:
+                legacy = orjson.loads(f.read())
+            conn.executemany("INSERT INTO kv (k, v) VALUES (?, ?)",
+                             [(k, orjson.dumps(v)) for k, v in legacy.items()])
+            conn.commit()
+            log.info("Cache %s overgenomen in %s (%d gemeenten)",
+                     os.path.basename(LEGACY_CACHE_FILE), os.path.basename(CACHE_FILE), len(legacy))
+        _cache_db = conn
+    return _cache_db
+
+
 def load_cache():
     """Load cached GBIF results."""
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
+    return {k: orjson.loads(v) for k, v in cache_db().execute("SELECT k, v FROM kv")}
 
 
-def save_cache(cache):
-    """Save GBIF results to cache."""
-    with open(CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(cache, f, ensure_ascii=False, indent=2)
+def save_cache(norm, data):
+    """Store the GBIF result of one gemeente in the cache."""
+    conn = cache_db()
+    conn.execute("INSERT OR REPLACE INTO kv (k, v) VALUES (?, ?)", (norm, orjson.dumps(data)))
+    conn.commit()
 
 
-def enrich_file(filename, gadm_mapping, cache, skip_cached=True):
-    """Enrich a single GeoJSON file with flora/fauna data."""
+def enrich_file(filename, gadm_mapping, cache, skip_cached=True, ndjson=False):
+    """Enrich a single GeoJSON file with flora/fauna data.
+
+    gadm_mapping is the (gid_by_norm, original_by_norm) pair from fetch_gadm_mapping.
+    """
     base = os.path.splitext(os.path.basename(filename))[0]
     parts = base.split("_")
     if len(parts) != 2:
@@ -229,25 +384,32 @@ def enrich_file(filename, gadm_mapping, cache, skip_cached=True):
     log.info("=" * 55)
 
     # Load GeoJSON
-    log.info("Laden: %s...", filename)
-    with open(filename, "r", encoding="utf-8") as fh:
-        geojson = json.load(fh)
+    log.info("Laden: %s...", os.path.basename(filename))
+    with open(filename, "rb") as fh:
+        geojson = orjson.loads(fh.read())
     features = geojson.get("features", [])
     log.info("  %d features", len(features))
 
-    # Collect unique gemeente names
-    gemeente_namen = set()
+    # Collect unique gemeente names, with the properties of their features
+    # so the merge below only visits features that can get data
+    props_by_naam = {}  # {naam: [properties, ...]}
     for f in features:
-        naam = f.get("properties", {}).get(name_field, "")
+        props = f.get("properties", {})
+        naam = props.get(name_field, "")
         if naam:
-            gemeente_namen.add(naam)
+            props_by_naam.setdefault(naam, []).append(props)
+    gemeente_namen = props_by_naam.keys()
     log.info("  %d unieke gemeenten", len(gemeente_namen))
 
+    gid_by_norm, original_by_norm = gadm_mapping
+    sorted_norms = sorted(gid_by_norm)  # for the fuzzy match
+
     # Fetch data per gemeente (with caching)
     ff_data = {}  # {normalized_name: {indicators}}
     total = len(gemeente_namen)
     done = 0
     new_fetched = 0
+    to_fetch = []  # (naam, norm, gid)
 
     for naam in sorted(gemeente_namen):
         done += 1
@@ -259,60 +421,59 @@ def enrich_file(filename, gadm_mapping, cache, skip_cached=True):
             continue
 
         # Find GADM GID
-        gid = gadm_mapping.get(norm)
-        if not gid:
-            # Try fuzzy match
-            for gadm_norm, gadm_gid in gadm_mapping.items():
-                if gadm_norm.endswith("__original"):
-                    continue
-                if norm in gadm_norm or gadm_norm in norm:
-                    gid = gadm_gid
-                    break
+        gid = gid_by_norm.get(norm)
+        if not gid and norm:
+            match = fuzzy_gadm_match(norm, gid_by_norm, sorted_norms)
+            if match:
+                gid = gid_by_norm[match]
+                log.info("  %s: fuzzy match met GADM '%s'", naam, original_by_norm[match])
 
         if not gid:
             log.warning("  [%d/%d] %s: GEEN GADM match gevonden", done, total, naam)
             continue
 
-        log.info("  [%d/%d] %s (GADM: %s)...", done, total, naam, gid)
-        data = fetch_gemeente_data(gid, naam)
-        ff_data[norm] = data
-        cache[norm] = data
-        new_fetched += 1
+        to_fetch.append((naam, norm, gid))
 
-        # Save cache periodically
-        if new_fetched % 10 == 0:
-            save_cache(cache)
-            log.info("  Cache opgeslagen (%d nieuwe gemeenten)", new_fetched)
+    # Fetch concurrently; results are handled here in the main thread, so
+    # ff_data, cache and the cache database need no lock
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS)
+    try:
+        futures = {
+            executor.submit(fetch_gemeente_data, gid, naam): (naam, norm, gid)
+            for naam, norm, gid in to_fetch
+        }
+        for future in concurrent.futures.as_completed(futures):
+            naam, norm, gid = futures[future]
+            data = future.result()
+            ff_data[norm] = data
+            cache[norm] = data
+            save_cache(norm, data)
+            new_fetched += 1
+            log.info("  [%d/%d] %s (GADM: %s)", new_fetched, len(to_fetch), naam, gid)
+    finally:
+        # On Ctrl+C, do not wait for the rest of the queue
+        executor.shutdown(wait=True, cancel_futures=True)
 
-    # Save final cache
     if new_fetched > 0:
-        save_cache(cache)
         log.info("  %d nieuwe gemeenten opgehaald, %d uit cache", new_fetched, done - new_fetched)
 
     # Merge into GeoJSON
     enriched = 0
     indicators_with_data = set()
 
-    for f in features:
-        props = f.get("properties", {})
-        naam = props.get(name_field, "")
-        if not naam:
-            continue
-
-        norm = normalize_naam(naam)
-        row = ff_data.get(norm)
+    for naam, props_list in props_by_naam.items() if ff_data else ():
+        row = ff_data.get(normalize_naam(naam))
         if not row:
             continue
 
-        any_added = False
-        for key, val in row.items():
-            if val is not None and val > 0:
-                props[key] = val
-                indicators_with_data.add(key)
-                any_added = True
-
-        if any_added:
-            enriched += 1
+        # Same values for every feature of this gemeente
+        values = {key: val for key, val in row.items() if val is not None and val > 0}
+        if not values:
+            continue
+        indicators_with_data.update(values)
+        for props in props_list:
+            props.update(values)
+        enriched += len(props_list)
 
     log.info("  %d/%d features verrijkt", enriched, len(features))
     log.info("  %d indicatoren met data", len(indicators_with_data))
@@ -331,9 +492,16 @@ def enrich_file(filename, gadm_mapping, cache, skip_cached=True):
     geojson["metadata"] = meta
 
     # Save
-    log.info("Opslaan: %s...", filename)
-    with open(filename, "w", encoding="utf-8") as fh:
-        json.dump(geojson, fh, ensure_ascii=False, separators=(",", ":"))
+    # Write to a temp file and swap atomically: an interrupted run leaves
+    # the original intact
+    log.info("Opslaan: %s...", os.path.basename(filename))
+    tmp_path = filename + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(orjson.dumps(geojson))
+    os.replace(tmp_path, filename)
+    if ndjson:
+        write_ndjson(ndjson_path(filename), meta, features)
+        log.info("  %s geschreven", os.path.basename(ndjson_path(filename)))
 
     size_mb = os.path.getsize(filename) / (1024 * 1024)
     log.info("  %.1f MB - KLAAR!", size_mb)
@@ -342,11 +510,12 @@ def enrich_file(filename, gadm_mapping, cache, skip_cached=True):
 
 
 def find_geojson_files(feat_type=None, year=None):
-    """Find matching GeoJSON files."""
+    """Find matching GeoJSON files in the app directory (absolute paths)."""
     files = []
-    for f in os.listdir("."):
-        if not f.endswith(".geojson") or f.startswith("bag"):
-            continue
+    with os.scandir(APP_DIR) as it:
+        names = [e.name for e in it
+                 if e.name.endswith(".geojson") and not e.name.startswith("bag") and e.is_file()]
+    for f in names:
         base = f.replace(".geojson", "")
         parts = base.split("_")
         if len(parts) != 2:
@@ -357,7 +526,7 @@ def find_geojson_files(feat_type=None, year=None):
         if year and fyear != str(year):
             continue
         if ftype in ("gemeenten", "buurten", "wijken"):
-            files.append(f)
+            files.append(os.path.join(APP_DIR, f))
     return sorted(files)
 
 
@@ -372,9 +541,12 @@ def main():
                         help="Gebruik cache en sla al opgehaalde gemeenten over")
     parser.add_argument("--no-cache", action="store_true",
                         help="Negeer cache, alles opnieuw ophalen")
+    parser.add_argument("--ndjson", action="store_true",
+                        help="Schrijf ook een .geojsonl.gz (één feature per regel)")
     args = parser.parse_args()
 
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    global http_cache_read
+    http_cache_read = not args.no_cache
 
     files = find_geojson_files(args.type, args.year)
     if not files:
@@ -387,7 +559,7 @@ def main():
 
     # Load GADM mapping
     gadm_mapping = fetch_gadm_mapping()
-    if not gadm_mapping:
+    if not gadm_mapping[0]:
         log.error("Kan GADM mapping niet laden!")
         return 1
 
@@ -400,14 +572,14 @@ def main():
     success = 0
     for filename in files:
         try:
-            if enrich_file(filename, gadm_mapping, cache, skip_cached=(not args.no_cache)):
+            if enrich_file(filename, gadm_mapping, cache, skip_cached=(not args.no_cache),
+                           ndjson=args.ndjson):
                 success += 1
         except KeyboardInterrupt:
-            log.info("\nOnderbroken! Cache opgeslagen.")
-            save_cache(cache)
+            log.info("\nOnderbroken! Opgehaalde gemeenten staan in de cache.")
             return 1
         except Exception as e:
-            log.error("FOUT bij %s: %s", filename, e)
+            log.error("FOUT bij %s: %s", os.path.basename(filename), e)
             import traceback
             traceback.print_exc()
 
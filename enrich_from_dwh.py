@@ -314,8 +314,11 @@ def enrich_file(filename, zk_data, cr_data, domains):
 
     # Save
     log.info("Opslaan: %s...", filename)
-    with open(filename, "w", encoding="utf-8") as fh:
+    # Temp file + rename: an interrupted write leaves the original intact
+    tmp_path = filename + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
         json.dump(geojson, fh, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, filename)
 
     size_mb = os.path.getsize(filename) / (1024 * 1024)
     log.info("  %.1f MB - KLAAR!", size_mb)
@@ -14,20 +14,31 @@ Usage:
     python enrich_from_sql.py                              # All GeoJSON files
     python enrich_from_sql.py --type gemeenten --year 2024 # Specific file
     python enrich_from_sql.py --domains bodemgebruik       # Only bodemgebruik
+    python enrich_from_sql.py --no-cache                   # Download CBS tables again
+    python enrich_from_sql.py --ndjson                     # Also .geojsonl.gz; streams from it next time
 
 Dependencies:
-    pip install cbsodata
+    pip install cbsodata orjson
 """
 
 import argparse
-import json
+import concurrent.futures
+import functools
+import gzip
 import logging
+import multiprocessing
 import os
 import re
+import shutil
 import sys
 import time
+from bisect import bisect_left, bisect_right
+from contextlib import nullcontext
 
 import cbsodata
+import orjson
+
+from geojsonl import ndjson_header, ndjson_path, read_ndjson
 
 logging.basicConfig(
     level=logging.INFO,
@@ -58,46 +69,98 @@ CBS_BBG_TABLE = "70262ned"
 # CBS Landbouw dataset: 80781ned (per gemeente, op naam)
 CBS_LBT_TABLE = "80781ned"
 
+# Downloaded CBS tables are kept here for a day
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+CBS_CACHE_MAX_AGE = 24 * 3600  # seconds
+
+# Kolommen die we lezen; de rest van de tabel wordt niet gedownload
+BBG_COLUMNS = [
+    "RegioS", "Perioden", "TotaleOppervlakte_1", "TotaalBebouwdTerrein_6",
+    "TotaalAgrarischTerrein_25", "TotaalBosEnOpenNatuurlijkTerrein_28",
+    "TotaalRecreatieterrein_19", "Woonterrein_7", "Bedrijventerrein_11",
+]
+# Inclusief de alternatieve kolomnamen (verschillen per tabelversie)
+LBT_COLUMNS = [
+    "RegioS", "Perioden", "AantalLandbouwbedrijvenTotaal_1",
+    "Cultuurgrond_3", "Cultuurgrond_6", "RundveeTotaal_84", "RundveeTotaal_103",
+    "VarkensTotaal_121", "VarkensTotaal_136", "KippenTotaal_125", "KippenTotaal_140",
+]
+
 # Peiljaren bodemgebruik beschikbaar bij CBS
 BBG_PEILJAREN = [1996, 2000, 2003, 2006, 2008, 2010, 2012, 2015, 2017]
 
+# Bestanden tegelijk (processen); elk bestand staat volledig in het geheugen
+ENRICH_WORKERS = min(4, os.cpu_count() or 1)
+
+# Suffixes like " (gemeente)", " (SG)", " (GA)"; also stacked, "X (SG) (gemeente)"
+_SUFFIX_RE = re.compile(r'(?:\s*\((?:gemeente|SG|GA)\))+\s*$')
+# Regio-aggregates with suffixes like (LB), (CR), (LD), (PV)
+_REGIO_SUFFIX_RE = re.compile(r'\((?:LB|CR|LD|PV)\)\s*$')
+_YEAR_RE = re.compile(r"\s*(\d{4})")
+
 
+@functools.lru_cache(maxsize=4096)
 def normalize_naam(naam):
-    """Normalize gemeente naam for matching.
+    """Normalize gemeente naam for matching (memoized: names repeat for every year).
     CBS uses forms like "'s-Gravenhage (gemeente)" or "Utrecht (gemeente)".
     GeoJSON uses "'s-Gravenhage" or "Utrecht".
     """
     if not naam:
         return ""
     naam = naam.strip()
-    # Remove suffixes like " (gemeente)", " (SG)", " (GA)"
-    naam = re.sub(r'\s*\(gemeente\)\s*$', '', naam)
-    naam = re.sub(r'\s*\(SG\)\s*$', '', naam)
-    naam = re.sub(r'\s*\(GA\)\s*$', '', naam)
-    return naam.strip().lower()
+    # Most names have no suffix at all; skip the regex for those
+    if '(' in naam:
+        naam = _SUFFIX_RE.sub('', naam).strip()
+    return naam.lower()
 
 
+@functools.lru_cache(maxsize=4096)
 def is_gemeente_regio(naam):
     """Check if a RegioS value is a gemeente (not a regio/province/landsdeel)."""
     if not naam:
         return False
     naam = naam.strip()
-    # Skip regio-aggregates with suffixes like (LB), (CR), (LD), (PV)
-    if re.search(r'\((LB|CR|LD|PV)\)\s*$', naam):
+    if naam == 'Nederland':
         return False
-    if naam in ('Nederland',):
+    # Skip regio-aggregates with suffixes like (LB), (CR), (LD), (PV)
+    if '(' in naam and _REGIO_SUFFIX_RE.search(naam):
         return False
     return True
 
 
-def fetch_bodemgebruik():
+def cbs_get_data(table, use_cache=True, select=None):
+    """cbsodata.get_data(table), cached on disk as .cache/cbs_<table>.json.
+
+    select limits the download to those columns ($select); columns the
+    table does not have are dropped first, since OData rejects them.
+    """
+    path = os.path.join(CACHE_DIR, f"cbs_{table}.json")
+    if use_cache and os.path.exists(path) and time.time() - os.path.getmtime(path) < CBS_CACHE_MAX_AGE:
+        with open(path, "rb") as fh:
+            data = orjson.loads(fh.read())
+        log.info("  %s uit cache", table)
+        return data
+
+    if select:
+        keys = {p.get("Key") for p in cbsodata.get_meta(table, "DataProperties")}
+        select = [c for c in select if c in keys]
+    data = cbsodata.get_data(table, select=select or None)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as fh:
+        fh.write(orjson.dumps(data))
+    os.replace(tmp_path, path)
+    return data
+
+
+def fetch_bodemgebruik(use_cache=True):
     """
     Fetch bodemgebruik data from CBS Open Data API.
     Returns dict: {(gemeente_naam_lower, peiljaar): {field: val, ...}}
     """
     log.info("CBS Bodemgebruik ophalen (tabel %s)...", CBS_BBG_TABLE)
     try:
-        data = cbsodata.get_data(CBS_BBG_TABLE)
+        data = cbs_get_data(CBS_BBG_TABLE, use_cache, select=BBG_COLUMNS)
     except Exception as e:
         log.error("CBS API fout: %s", e)
         return {}
@@ -105,32 +168,34 @@ def fetch_bodemgebruik():
     log.info("  %d rijen opgehaald", len(data))
 
     result = {}
+    is_gemeente, norm = is_gemeente_regio, normalize_naam  # locals in the row loop
     for row in data:
-        regio = str(row.get("RegioS", "")).strip()
-        periode = str(row.get("Perioden", "")).strip()
+        row_get = row.get
+        # cbsodata returns strings already; strip happens in is_gemeente/norm
+        regio = row_get("RegioS")
 
         # Only gemeente-level
-        if not is_gemeente_regio(regio):
+        if not regio or not is_gemeente(regio):
             continue
 
         # Parse year
-        jaar_match = re.match(r"(\d{4})", periode)
+        jaar_match = _YEAR_RE.match(row_get("Perioden") or "")
         if not jaar_match:
             continue
         peiljaar = int(jaar_match.group(1))
 
-        totaal = row.get("TotaleOppervlakte_1") or 0
+        totaal = row_get("TotaleOppervlakte_1") or 0
         if totaal <= 0:
             continue
 
-        bebouwd = row.get("TotaalBebouwdTerrein_6") or 0
-        agrarisch = row.get("TotaalAgrarischTerrein_25") or 0
-        natuur = row.get("TotaalBosEnOpenNatuurlijkTerrein_28") or 0
-        recreatie = row.get("TotaalRecreatieterrein_19") or 0
-        woon = row.get("Woonterrein_7") or 0
-        bedrijf = row.get("Bedrijventerrein_11") or 0
+        bebouwd = row_get("TotaalBebouwdTerrein_6") or 0
+        agrarisch = row_get("TotaalAgrarischTerrein_25") or 0
+        natuur = row_get("TotaalBosEnOpenNatuurlijkTerrein_28") or 0
+        recreatie = row_get("TotaalRecreatieterrein_19") or 0
+        woon = row_get("Woonterrein_7") or 0
+        bedrijf = row_get("Bedrijventerrein_11") or 0
 
-        naam_key = normalize_naam(regio)
+        naam_key = norm(regio)
         result[(naam_key, peiljaar)] = {
             "bbg_peiljaar": peiljaar,
             "pct_bebouwd": round(bebouwd / totaal * 100, 2) if totaal else None,
@@ -145,63 +210,64 @@ def fetch_bodemgebruik():
     return result
 
 
-def fetch_landbouw():
+def fetch_landbouw(use_cache=True):
     """
     Fetch landbouw data from CBS Open Data API (tabel 80781ned).
     Returns dict: {(gemeente_naam_lower, jaar): {field: val, ...}}
     """
     log.info("CBS Landbouw ophalen (tabel %s)...", CBS_LBT_TABLE)
     try:
-        data = cbsodata.get_data(CBS_LBT_TABLE)
+        data = cbs_get_data(CBS_LBT_TABLE, use_cache, select=LBT_COLUMNS)
     except Exception as e:
         log.error("CBS API fout: %s", e)
         return {}
 
     log.info("  %d rijen opgehaald", len(data))
 
+    def to_num(v):
+        if v is None:
+            return None
+        try:
+            n = float(v)
+            return round(n, 1) if n != int(n) else int(n)
+        except (ValueError, TypeError):
+            return None
+
     result = {}
+    is_gemeente, norm = is_gemeente_regio, normalize_naam  # locals in the row loop
     for row in data:
-        regio = str(row.get("RegioS", "")).strip()
-        periode = str(row.get("Perioden", "")).strip()
+        row_get = row.get
+        regio = row_get("RegioS")
 
-        if not is_gemeente_regio(regio):
+        if not regio or not is_gemeente(regio):
             continue
 
-        jaar_match = re.match(r"(\d{4})", periode)
+        jaar_match = _YEAR_RE.match(row_get("Perioden") or "")
         if not jaar_match:
             continue
         jaar = int(jaar_match.group(1))
 
-        cultuurgrond = row.get("Cultuurgrond_3")
-        rundvee = row.get("RundveeTotaal_84")
-        varkens = row.get("VarkensTotaal_121")
-        kippen = row.get("KippenTotaal_125")
-        bedrijven = row.get("AantalLandbouwbedrijvenTotaal_1")
+        cultuurgrond = row_get("Cultuurgrond_3")
+        rundvee = row_get("RundveeTotaal_84")
+        varkens = row_get("VarkensTotaal_121")
+        kippen = row_get("KippenTotaal_125")
+        bedrijven = row_get("AantalLandbouwbedrijvenTotaal_1")
 
         # Fallback: alternatieve kolomnamen
         if cultuurgrond is None:
-            cultuurgrond = row.get("Cultuurgrond_6")
+            cultuurgrond = row_get("Cultuurgrond_6")
         if rundvee is None:
-            rundvee = row.get("RundveeTotaal_103")
+            rundvee = row_get("RundveeTotaal_103")
         if varkens is None:
-            varkens = row.get("VarkensTotaal_136")
+            varkens = row_get("VarkensTotaal_136")
         if kippen is None:
-            kippen = row.get("KippenTotaal_140")
+            kippen = row_get("KippenTotaal_140")
 
         has_data = any(v is not None and v != 0 for v in [cultuurgrond, rundvee, varkens, kippen, bedrijven])
         if not has_data:
             continue
 
-        def to_num(v):
-            if v is None:
-                return None
-            try:
-                n = float(v)
-                return round(n, 1) if n != int(n) else int(n)
-            except (ValueError, TypeError):
-                return None
-
-        naam_key = normalize_naam(regio)
+        naam_key = norm(regio)
         result[(naam_key, jaar)] = {
             "lbt_totaal_cultuurgrond_ha": to_num(cultuurgrond),
             "lbt_totaal_rundvee": to_num(rundvee),
@@ -214,14 +280,43 @@ def fetch_landbouw():
     return result
 
 
-def find_nearest_peiljaar(peiljaren, target_year):
-    """Find nearest peiljaar <= target_year."""
-    candidates = [p for p in peiljaren if p <= target_year]
-    return max(candidates) if candidates else None
+def group_by_name(data):
+    """{(naam_key, jaar): row} -> {naam_key: {jaar: row}}, for one lookup per feature."""
+    grouped = {}
+    for (naam_key, jaar), row in data.items():
+        grouped.setdefault(naam_key, {})[jaar] = row
+    return grouped
 
 
-def enrich_file(filename, bbg_data, lbt_data, domains):
-    """Enrich a single GeoJSON file."""
+def find_nearest_peiljaar(peiljaren, target_year):
+    """Find nearest peiljaar <= target_year (peiljaren sorted)."""
+    i = bisect_right(peiljaren, target_year)
+    return peiljaren[i - 1] if i else None
+
+
+def find_adjacent_year(years, target_year, max_offset=2):
+    """Nearest year in sorted years within max_offset; the earlier one wins a tie."""
+    i = bisect_left(years, target_year)
+    before = years[i - 1] if i else None
+    after = years[i] if i < len(years) else None
+    if before is not None and (after is None or target_year - before <= after - target_year):
+        best = before
+    else:
+        best = after
+    if best is not None and abs(best - target_year) <= max_offset:
+        return best
+    return None
+
+
+def enrich_file(filename, bbg_by_name, lbt_by_name, domains, ndjson=False):
+    """Enrich a single GeoJSON file.
+
+    bbg_by_name and lbt_by_name are the CBS data grouped by group_by_name.
+    Features are written one by one while merging. With ndjson=True a
+    .geojsonl.gz sidecar is written too, and if an up-to-date sidecar
+    already exists the features are read from it line by line instead of
+    loading the whole FeatureCollection.
+    """
     base = os.path.splitext(os.path.basename(filename))[0]
     parts = base.split("_")
     if len(parts) != 2:
@@ -245,35 +340,59 @@ def enrich_file(filename, bbg_data, lbt_data, domains):
     log.info("  ENRICH %s %d", feat_type.upper(), year)
     log.info("=" * 55)
 
-    # Load GeoJSON
-    log.info("Laden: %s...", filename)
-    with open(filename, "r", encoding="utf-8") as fh:
-        geojson = json.load(fh)
-    features = geojson.get("features", [])
-    log.info("  %d features", len(features))
+    side_path = ndjson_path(filename)
+    meta = None
+    if ndjson and os.path.exists(side_path) and os.path.getmtime(side_path) >= os.path.getmtime(filename):
+        # Stream from the sidecar: one feature in memory at a time
+        meta, features = read_ndjson(side_path)
+        if meta is None:
+            log.warning("  %s heeft geen metadata-regel; .geojson wordt geladen",
+                        os.path.basename(side_path))
+        else:
+            log.info("Streamen: %s...", os.path.basename(side_path))
+    if meta is None:
+        # Load GeoJSON
+        log.info("Laden: %s...", filename)
+        with open(filename, "rb") as fh:
+            geojson = orjson.loads(fh.read())
+        meta = geojson.get("metadata", {})
+        features = geojson.get("features", [])
+        del geojson
+        log.info("  %d features", len(features))
+
+    # Sorted lbt years per gemeente, for the adjacent-year fallback
+    lbt_years = {naam_key: sorted(years) for naam_key, years in lbt_by_name.items()}
 
     # Find nearest BBG peiljaar
-    available_bbg_years = sorted(set(pj for (_, pj) in bbg_data.keys())) if bbg_data else []
+    available_bbg_years = sorted({pj for years in bbg_by_name.values() for pj in years})
     nearest_pj = find_nearest_peiljaar(available_bbg_years, year)
     if nearest_pj:
         log.info("  Bodemgebruik: peiljaar %d (voor CBS jaar %d)", nearest_pj, year)
 
-    # Merge
+    # Merge, writing each feature as soon as it is done. The metadata is
+    # only known afterwards, so the features go to a body file first and
+    # the envelope (metadata first, as in every other writer) is put in
+    # front of it; a temp file + rename keeps the original intact
     enriched = 0
+    count = 0
     indicators_with_data = set()
+    norm = normalize_naam
+    tmp_path = filename + ".tmp"
+    body_tmp = filename + ".features.tmp"
+    side_tmp = side_path + ".tmp"
 
-    for f in features:
-        props = f.get("properties", {})
+    def merge_feature(props):
+        """Add the CBS values for this feature's gemeente; True if anything was added."""
         gem_naam = props.get(name_field, "")
         if not gem_naam:
-            continue
+            return False
 
-        naam_key = normalize_naam(gem_naam)
+        naam_key = norm(gem_naam)
         any_added = False
 
         # Bodemgebruik
         if "bodemgebruik" in domains and nearest_pj and naam_key:
-            bbg_row = bbg_data.get((naam_key, nearest_pj))
+            bbg_row = bbg_by_name.get(naam_key, {}).get(nearest_pj)
             if bbg_row:
                 for key, val in bbg_row.items():
                     if val is not None:
@@ -284,13 +403,13 @@ def enrich_file(filename, bbg_data, lbt_data, domains):
 
         # Landbouw
         if "landbouw" in domains and naam_key:
-            lbt_row = lbt_data.get((naam_key, year))
-            # Fallback: try adjacent years
+            year_map = lbt_by_name.get(naam_key, {})
+            lbt_row = year_map.get(year)
+            # Fallback: nearest adjacent year (at most 2 away)
             if not lbt_row:
-                for offset in [-1, 1, -2, 2]:
-                    lbt_row = lbt_data.get((naam_key, year + offset))
-                    if lbt_row:
-                        break
+                adjacent = find_adjacent_year(lbt_years.get(naam_key, ()), year)
+                if adjacent is not None:
+                    lbt_row = year_map[adjacent]
             if lbt_row:
                 for key, val in lbt_row.items():
                     if val is not None:
@@ -298,30 +417,56 @@ def enrich_file(filename, bbg_data, lbt_data, domains):
                         indicators_with_data.add(key)
                         any_added = True
 
-        if any_added:
-            enriched += 1
-
-    log.info("  %d/%d features verrijkt", enriched, len(features))
+        return any_added
+
+    with open(body_tmp, "wb") as out, \
+            (gzip.open(side_tmp, "wb", compresslevel=6) if ndjson else nullcontext()) as side:
+        for f in features:
+            enriched += merge_feature(f.get("properties", {}))
+            blob = orjson.dumps(f)
+            if count:
+                out.write(b",")
+            out.write(blob)
+            if side is not None:
+                side.write(blob + b"\n")
+            count += 1
+
+    log.info("  %d/%d features verrijkt", enriched, count)
     log.info("  %d indicatoren met data", len(indicators_with_data))
 
     if not indicators_with_data:
         log.warning("  Geen data gevonden voor dit bestand")
+        os.remove(body_tmp)
+        if ndjson:
+            os.remove(side_tmp)
         return False
 
     # Update metadata
-    meta = geojson.get("metadata", {})
     existing = set(meta.get("indicators", []))
     meta["indicators"] = sorted(existing | indicators_with_data)
     meta["indicators_count"] = len(meta["indicators"])
     meta["enriched_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
     if nearest_pj and "bodemgebruik" in domains:
         meta["bbg_peiljaar"] = nearest_pj
-    geojson["metadata"] = meta
 
-    # Save
     log.info("Opslaan: %s...", filename)
-    with open(filename, "w", encoding="utf-8") as fh:
-        json.dump(geojson, fh, ensure_ascii=False, separators=(",", ":"))
+    with open(tmp_path, "wb") as fh, open(body_tmp, "rb") as body:
+        fh.write(b'{"type":"FeatureCollection","metadata":')
+        fh.write(orjson.dumps(meta))
+        fh.write(b',"features":[')
+        shutil.copyfileobj(body, fh, 1024 * 1024)
+        fh.write(b"]}")
+    os.remove(body_tmp)
+    os.replace(tmp_path, filename)
+    if ndjson:
+        # Metadata line first: a separate gzip member before the features
+        # (concatenated members form one valid gzip stream)
+        with open(side_path + ".part", "wb") as fh, open(side_tmp, "rb") as body:
+            fh.write(gzip.compress(ndjson_header(meta)))
+            shutil.copyfileobj(body, fh, 1024 * 1024)
+        os.remove(side_tmp)
+        os.replace(side_path + ".part", side_path)
+        log.info("  %s geschreven", os.path.basename(side_path))
 
     size_mb = os.path.getsize(filename) / (1024 * 1024)
     log.info("  %.1f MB - KLAAR!", size_mb)
@@ -329,6 +474,19 @@ def enrich_file(filename, bbg_data, lbt_data, domains):
     return True
 
 
+_worker_args = None
+
+
+def _init_worker(bbg_by_name, lbt_by_name, domains, ndjson):
+    """Pool initializer: the CBS data is pickled once per process, not per file."""
+    global _worker_args
+    _worker_args = (bbg_by_name, lbt_by_name, domains, ndjson)
+
+
+def _enrich_file_worker(filename):
+    return enrich_file(filename, *_worker_args)
+
+
 def find_geojson_files(feat_type=None, year=None):
     """Find matching GeoJSON files."""
     files = []
@@ -360,6 +518,10 @@ def main():
                         choices=["bodemgebruik", "landbouw"],
                         default=["bodemgebruik", "landbouw"],
                         help="Welke domeinen (default: alle)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Negeer de lokale CBS-cache (.cache/) en download opnieuw")
+    parser.add_argument("--ndjson", action="store_true",
+                        help="Schrijf ook een .geojsonl.gz en verrijk daar regel voor regel uit als die actueel is")
     args = parser.parse_args()
 
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -377,12 +539,12 @@ def main():
     lbt_data = {}
 
     if "bodemgebruik" in args.domains:
-        bbg_data = fetch_bodemgebruik()
+        bbg_data = fetch_bodemgebruik(use_cache=not args.no_cache)
         if not bbg_data:
             log.warning("Geen bodemgebruik data opgehaald!")
 
     if "landbouw" in args.domains:
-        lbt_data = fetch_landbouw()
+        lbt_data = fetch_landbouw(use_cache=not args.no_cache)
         if not lbt_data:
             log.warning("Geen landbouw data opgehaald!")
 
@@ -390,16 +552,27 @@ def main():
         log.error("Geen data beschikbaar - kan niet verrijken")
         return 1
 
-    # Enrich files
+    # Per gemeente: {jaar: row}, eenmalig voor alle bestanden
+    bbg_by_name = group_by_name(bbg_data)
+    lbt_by_name = group_by_name(lbt_data)
+
+    # Enrich files, several at once: each file is an independent
+    # parse/merge/write
     success = 0
-    for filename in files:
-        try:
-            if enrich_file(filename, bbg_data, lbt_data, args.domains):
-                success += 1
-        except Exception as e:
-            log.error("FOUT bij %s: %s", filename, e)
-            import traceback
-            traceback.print_exc()
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(ENRICH_WORKERS, len(files)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker, initargs=(bbg_by_name, lbt_by_name, args.domains, args.ndjson)) as pool:
+        futures = {pool.submit(_enrich_file_worker, filename): filename for filename in files}
+        for future in concurrent.futures.as_completed(futures):
+            filename = futures[future]
+            try:
+                if future.result():
+                    success += 1
+            except Exception as e:
+                log.error("FOUT bij %s: %s", filename, e)
+                import traceback
+                traceback.print_exc()
 
     log.info("\n%s", '=' * 55)
     log.info("  KLAAR: %d/%d bestanden verrijkt", success, len(files))
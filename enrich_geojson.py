@@ -11,21 +11,23 @@ Usage:
     python enrich_geojson.py --type gemeenten --year 2024
     python enrich_geojson.py --type buurten --year 2024
     python enrich_geojson.py --type wijken --year 2024
+    python enrich_geojson.py --all --no-cache    # PDOK-velden opnieuw ophalen
 """
 
 import argparse
-import json
+import concurrent.futures
 import logging
 import os
 import sys
 import time
 
-import requests
+import orjson
 
 # Import from build_geojson
 from build_geojson import (
     PDOK_WFS, PDOK_FIELDS, ADMIN_FIELDS, ID_FIELD, AVAILABLE_YEARS,
-    get_layer_name, discover_fields, resolve_fields, clean_value, count_total,
+    get_layer_name, discover_fields, resolve_fields, count_total, values_getter, MISSING,
+    write_geojson, fetch_page, DOWNLOAD_WORKERS, PAGE_SIZE,
 )
 
 logging.basicConfig(
@@ -36,37 +38,44 @@ logging.basicConfig(
 )
 log = logging.getLogger("enrich")
 
-PAGE_SIZE = 1000
-
 
 def download_stats_only(base_url, type_name, prop_names, id_field, expected_total=-1):
-    """Download only properties (NO geometry) from PDOK WFS. Much faster!"""
+    """Download only properties (NO geometry) from PDOK WFS. Much faster!
+
+    With a known total all pages are requested concurrently over the
+    pooled build_geojson session.
+    """
     all_data = {}
-    start = 0
     # Request props WITHOUT geom
     prop_str = ",".join(prop_names)
 
-    while True:
-        params = {
-            "service": "WFS", "version": "2.0.0", "request": "GetFeature",
-            "typeNames": type_name, "outputFormat": "application/json",
-            "count": PAGE_SIZE, "startIndex": start,
-            "propertyName": prop_str,
-        }
-
-        pct = f" ({len(all_data)}/{expected_total})" if expected_total > 0 else f" ({len(all_data)})"
-        log.info(f"  PDOK stats page startIndex={start}{pct}...")
-        resp = requests.get(base_url, params=params, timeout=300)
-        resp.raise_for_status()
-        data = resp.json()
-        features = data.get("features", [])
-
+    def add(features):
         for f in features:
             props = f.get("properties", {})
             fid = props.get(id_field, "")
             if fid:
                 all_data[fid] = props
 
+    start = 0
+    if expected_total > 0:
+        starts = range(0, expected_total, PAGE_SIZE)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+            pages = executor.map(lambda st: fetch_page(base_url, type_name, prop_str, st), starts)
+            for st, data in zip(starts, pages):
+                features = data.get("features", [])
+                add(features)
+                log.info(f"  PDOK stats page startIndex={st} ({len(all_data)}/{expected_total})")
+        start = starts[-1] + PAGE_SIZE
+        # Telling kan achterlopen: doorgaan zolang de laatste pagina vol was
+        if len(features) < PAGE_SIZE:
+            return all_data
+
+    while True:
+        log.info(f"  PDOK stats page startIndex={start} ({len(all_data)})...")
+        data = fetch_page(base_url, type_name, prop_str, start)
+        features = data.get("features", [])
+        add(features)
+
         if len(features) == 0:
             break
         nm = data.get("numberMatched", expected_total)
@@ -79,8 +88,12 @@ def download_stats_only(base_url, type_name, prop_names, id_field, expected_tota
     return all_data
 
 
-def enrich_year(feat_type, year):
-    """Enrich an existing GeoJSON file with extra PDOK indicators."""
+def enrich_year(feat_type, year, use_cache=True):
+    """Enrich an existing GeoJSON file with extra PDOK indicators.
+
+    The available PDOK fields come from the build_geojson cache (memory,
+    then .cache/ on disk) unless use_cache is False.
+    """
     filename = f"{feat_type}_{year}.geojson"
 
     if not os.path.exists(filename):
@@ -98,21 +111,23 @@ def enrich_year(feat_type, year):
 
     # 1. Load existing GeoJSON
     log.info(f"Stap 1: {filename} laden...")
-    with open(filename, "r", encoding="utf-8") as fh:
-        geojson = json.load(fh)
+    with open(filename, "rb") as fh:
+        geojson = orjson.loads(fh.read())
     features = geojson.get("features", [])
     log.info(f"  {len(features)} features geladen")
 
-    # Check what indicators already exist
-    existing_keys = set()
-    for f in features[:10]:
-        existing_keys.update(f.get("properties", {}).keys())
+    # Check what indicators already exist: metadata.indicators (written by
+    # build_geojson and the enrich scripts); otherwise the first features
+    existing_keys = set(geojson.get("metadata", {}).get("indicators", []))
+    if not existing_keys:
+        for f in features[:10]:
+            existing_keys.update(f.get("properties", {}).keys())
     log.info(f"  Bestaande properties: {len(existing_keys)}")
 
     # 2. Discover available PDOK fields
     log.info(f"Stap 2: PDOK velden ontdekken ({type_name})...")
     try:
-        available = discover_fields(base_url, type_name)
+        available = discover_fields(base_url, type_name, use_cache)
     except Exception as e:
         log.error(f"  FOUT: {e}")
         return None
@@ -144,20 +159,28 @@ def enrich_year(feat_type, year):
     log.info("Stap 5: Mergen...")
     enriched = 0
     indicators_with_data = set()
+    app_keys = tuple(field_map)
+    get_pdok_values = values_getter(field_map.values())
 
     for f in features:
         props = f.get("properties", {})
-        fid = props.get(id_field, "")
-        if fid and fid in stats_data:
-            pdok_props = stats_data[fid]
-            for app_key, pdok_field in field_map.items():
-                v = clean_value(pdok_props.get(pdok_field))
-                if v is not None:
-                    if isinstance(v, float):
-                        v = round(v, 2)
-                    props[app_key] = v
-                    indicators_with_data.add(app_key)
-            enriched += 1
+        pdok_props = stats_data.get(props.get(id_field, ""))
+        if pdok_props is None:
+            continue
+        # Zelfde regels als clean_value, inline (zoals in build_year)
+        for app_key, v in zip(app_keys, get_pdok_values(pdok_props)):
+            if v is None:
+                continue
+            t = type(v)
+            if t is float:
+                if v <= MISSING:
+                    continue
+                v = round(v, 2)
+            elif t is int and v <= MISSING:
+                continue
+            props[app_key] = v
+            indicators_with_data.add(app_key)
+        enriched += 1
 
     log.info(f"  {enriched}/{len(features)} features verrijkt")
     log.info(f"  Indicatoren met data: {len(indicators_with_data)}")
@@ -173,10 +196,11 @@ def enrich_year(feat_type, year):
         "indicators_count": len(indicators_with_data),
     }
 
-    # 7. Save
+    # 7. Save: gechunkt naar een tijdelijk bestand, dan atomair vervangen
     log.info(f"Stap 6: Opslaan ({filename})...")
-    with open(filename, "w", encoding="utf-8") as fh:
-        json.dump(geojson, fh, ensure_ascii=False, separators=(",", ":"))
+    tmp_path = filename + ".tmp"
+    write_geojson(tmp_path, geojson["metadata"], features)
+    os.replace(tmp_path, filename)
 
     size_mb = os.path.getsize(filename) / (1024 * 1024)
     log.info(f"  {filename}: {size_mb:.1f} MB")
@@ -189,6 +213,8 @@ def main():
     parser.add_argument("--type", choices=["buurten", "wijken", "gemeenten"], default="gemeenten")
     parser.add_argument("--year", type=int, default=2024)
     parser.add_argument("--all", action="store_true", help="Enrich all existing GeoJSON files")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Negeer de lokale veldencache (.cache/) en vraag PDOK opnieuw")
     args = parser.parse_args()
 
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -199,11 +225,11 @@ def main():
                 fn = f"{ft}_{yr}.geojson"
                 if os.path.exists(fn):
                     try:
-                        enrich_year(ft, yr)
+                        enrich_year(ft, yr, use_cache=not args.no_cache)
                     except Exception as e:
                         log.error(f"Fout bij {ft} {yr}: {e}")
     else:
-        enrich_year(args.type, args.year)
+        enrich_year(args.type, args.year, use_cache=not args.no_cache)
 
 
 if __name__ == "__main__":
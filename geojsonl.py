@@ -0,0 +1,73 @@
+"""
+GeoJSON-tekstreeks naast een .geojson: <naam>.geojsonl.gz
+==========================================================
+Gedeeld door build_geojson, enrich_batch, enrich_flora_fauna en
+enrich_from_sql, zodat er één definitie van het formaat is:
+
+    {"type": "Metadata", "metadata": {...}}     <- eerste regel
+    {"type": "Feature", ...}                    <- één feature per regel
+
+De metadata staat in een eigen veld: de metadata van build_geojson heeft
+zelf een "type" (gemeenten/wijken/buurten) en mag het recordtype niet
+overschrijven.
+
+Dependencies:
+    pip install orjson
+"""
+
+import gzip
+import os
+from itertools import islice
+
+import orjson
+
+WRITE_CHUNK = 2000  # Features per join bij het schrijven
+
+
+def ndjson_path(path):
+    """Sidecar name for the line-delimited copy: buurten_2024.geojsonl.gz."""
+    return os.path.splitext(path)[0] + ".geojsonl.gz"
+
+
+def ndjson_header(metadata):
+    """The first line of a sidecar: the metadata record, newline included."""
+    return orjson.dumps({"type": "Metadata", "metadata": metadata}, option=orjson.OPT_APPEND_NEWLINE)
+
+
+def write_ndjson(path, metadata, features):
+    """Write a gzipped NDJSON copy: one metadata line, then one feature per line.
+
+    Lets a client render features as they stream in instead of waiting for
+    the whole FeatureCollection. features may be a list or an iterator.
+    """
+    features = iter(features)
+    with gzip.open(path, "wb", compresslevel=6) as fh:
+        fh.write(ndjson_header(metadata))
+        while True:
+            chunk = list(islice(features, WRITE_CHUNK))
+            if not chunk:
+                break
+            fh.write(b"".join(orjson.dumps(f, option=orjson.OPT_APPEND_NEWLINE) for f in chunk))
+
+
+def read_ndjson(path):
+    """Open a sidecar: (metadata, iterator over the features).
+
+    metadata is None when the first line is not a metadata record (an
+    older or foreign file); the caller should then use the .geojson.
+    """
+    lines = _iter_lines(path)
+    header = next(lines, None)
+    if not isinstance(header, dict) or header.get("type") != "Metadata" \
+            or not isinstance(header.get("metadata"), dict):
+        lines.close()
+        return None, iter(())
+    return header["metadata"], lines
+
+
+def _iter_lines(path):
+    """Yield the JSON objects of a sidecar, one line at a time."""
+    with gzip.open(path, "rb") as fh:
+        for line in fh:
+            if line.strip():
+                yield orjson.loads(line)
@@ -8,12 +8,13 @@ Gebruik:
     python serve.py
     python serve.py --port 8091
 """
+import gzip
 import http.server
-import socketserver
 import socket
 import sys
 import os
 import json
+import shutil
 import subprocess
 import threading
 import time
@@ -46,6 +47,36 @@ def get_data_freshness():
         return None
 
 
+_gzip_locks = {}  # path -> lock; alleen hetzelfde bestand wacht op elkaar
+_gzip_locks_lock = threading.Lock()
+
+
+def _gz_is_current(path, gz_path):
+    return os.path.exists(gz_path) and os.path.getmtime(gz_path) >= os.path.getmtime(path)
+
+
+def gzipped_copy(path):
+    """Pad naar een actuele path + '.gz' (zoals --gzip die schrijft); maakt hem
+    aan als hij ontbreekt of ouder is dan het origineel. None bij een fout."""
+    gz_path = path + '.gz'
+    try:
+        # Actueel: geen lock nodig (het .gz-bestand wordt atomair vervangen)
+        if _gz_is_current(path, gz_path):
+            return gz_path
+        with _gzip_locks_lock:
+            lock = _gzip_locks.setdefault(path, threading.Lock())
+        with lock:
+            # Intussen door een andere request aangemaakt?
+            if not _gz_is_current(path, gz_path):
+                tmp_path = gz_path + '.tmp'
+                with open(path, 'rb') as src, gzip.open(tmp_path, 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                os.replace(tmp_path, gz_path)
+    except OSError:
+        return None
+    return gz_path
+
+
 def run_refresh():
     """Draai het complete refresh-pipeline in een achtergrondthread."""
     global _refresh_running, _refresh_log, _refresh_last, _refresh_error
@@ -102,6 +133,30 @@ class Handler(http.server.SimpleHTTPRequestHandler):
         self.send_header('Cache-Control', 'no-cache')
         super().end_headers()
 
+    def send_head(self):
+        # GeoJSON gzip-gecomprimeerd versturen als de client dat accepteert (~5-10x kleiner)
+        path = self.translate_path(self.path)
+        if (path.endswith('.geojson') and 'gzip' in self.headers.get('Accept-Encoding', '')
+                and os.path.isfile(path)):
+            gz_path = gzipped_copy(path)
+            if gz_path:
+                f = open(gz_path, 'rb')
+                try:
+                    fs = os.fstat(f.fileno())
+                    self.send_response(200)
+                    self.send_header('Content-Type', self.guess_type(path))
+                    self.send_header('Content-Encoding', 'gzip')
+                    self.send_header('Content-Length', str(fs.st_size))
+                    # Tijd van het origineel: het .gz kan later aangemaakt zijn
+                    self.send_header('Last-Modified', self.date_time_string(os.path.getmtime(path)))
+                    self.send_header('Vary', 'Accept-Encoding')
+                    self.end_headers()
+                    return f
+                except Exception:
+                    f.close()
+                    raise
+        return super().send_head()
+
     def log_message(self, format, *args):
         # Verberg /api/status polling uit de logs
         if '/api/status' not in (args[0] if args else ''):
@@ -169,12 +224,10 @@ def get_local_ip():
         return "localhost"
 
 
-# Use ThreadingTCPServer for concurrent requests (refresh + UI)
-class ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
-    allow_reuse_address = True
-
-
-with ThreadedServer(("0.0.0.0", PORT), Handler) as httpd:
+# Eén thread per request (refresh + UI + grote GeoJSON tegelijk). Daemon-threads:
+# Ctrl+C wacht niet tot lopende downloads klaar zijn
+with http.server.ThreadingHTTPServer(("0.0.0.0", PORT), Handler) as httpd:
+    httpd.daemon_threads = True
     local_ip = get_local_ip()
     freshness = get_data_freshness()
     print("=" * 50)
@@ -0,0 +1,33 @@
+"""Round-trip tests for the .geojsonl.gz sidecar format (geojsonl.py)."""
+
+import gzip
+
+from geojsonl import ndjson_path, read_ndjson, write_ndjson
+
+
+def test_metadata_type_does_not_override_record_type(tmp_path):
+    # build_geojson and enrich_batch metadata carry their own "type"
+    metadata = {"type": "buurten", "year": 2024, "indicators": ["a"]}
+    features = [{"type": "Feature", "properties": {"i": i}, "geometry": None} for i in range(5)]
+    path = str(tmp_path / "buurten_2024.geojsonl.gz")
+
+    write_ndjson(path, metadata, iter(features))
+    meta, read_back = read_ndjson(path)
+
+    assert meta == metadata
+    assert list(read_back) == features
+
+
+def test_missing_header_is_rejected(tmp_path):
+    path = str(tmp_path / "oud.geojsonl.gz")
+    with gzip.open(path, "wb") as fh:
+        fh.write(b'{"type":"buurten","year":2024}\n{"type":"Feature","properties":{}}\n')
+
+    meta, features = read_ndjson(path)
+
+    assert meta is None
+    assert list(features) == []
+
+
+def test_ndjson_path():
+    assert ndjson_path("/data/buurten_2024.geojson") == "/data/buurten_2024.geojsonl.gz"